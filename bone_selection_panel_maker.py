@@ -2,62 +2,445 @@ bl_info = {
     "name"     : "Bone Selection Facilitator",
     "category" : "Animation",
     "author"   : "Tamir Lousky",
-    "version"  : "1.0"
+    "version"  : "2.0",
+    "location" : "3D View >> Properties >> Bone Selection Sets (Pose Mode)"
 }
 
-import bpy, time
+import bpy, re, json, zlib
+from bpy_extras.io_utils import ExportHelper, ImportHelper
 
-prefix   = 'bone_selector_'             # Textfile prefix
-now_time = time.localtime( time.time()) # Current time
-filename = prefix + str(now_time)       # Concatenate prefix and time to create unique name
+# Selection sets are stored on the armature (so they're saved with it) as an
+# ID property group mapping each set's name to an array of bone indices.
+# Exported sets use bone names instead, so they can be remapped to any rig
+sets_prop = 'bone_selection_sets'
 
-# Create a new text file in the text editor
-bpy.data.texts.new(name=filename)
-textfile = bpy.data.texts[filename]
+def get_sets_owner( obj ):
+    """ Selection sets are kept on the armature data, or on the object itself
+    when the armature is linked from a library (and so can't be edited) """
+    return obj if obj.data.library else obj.data
 
-textfile_template = """
+def has_selection_sets( obj ):
+    return obj and obj.type == 'ARMATURE' and sets_prop in get_sets_owner( obj )
 
-import bpy
+def get_selection_sets( obj ):
+    """ Return an armature object's selection sets group, creating it if needed """
+    owner = get_sets_owner( obj )
+    if sets_prop not in owner:
+        owner[ sets_prop ] = {}
+    return owner[ sets_prop ]
 
-class bone_selection_panel(bpy.types.Panel):
+def armature_key( armature ):
+    """ Identify an armature, including linked ones that share its name """
+    return ( armature.name, armature.library.filepath if armature.library else '' )
+
+def read_selection( bones ):
+    """ Return the indices of the selected bones """
+    flags = [ False ] * len( bones )
+    bones.foreach_get( 'select', flags )
+    return [ i for i, selected in enumerate( flags ) if selected ]
+
+def apply_selection( bones, indices, extend = False ):
+    """ Select the bones with the given indices in a single call """
+    flags = [ False ] * len( bones )
+    if extend:
+        bones.foreach_get( 'select', flags )
+
+    for i in indices:
+        if i < len( flags ):
+            flags[i] = True
+
+    bones.foreach_set( 'select', flags )
+
+def combine_sets( operation, a, b, bone_count ):
+    """ Combine two index arrays as sets. Inverting only uses the first one """
+    a = set( a )
+    if operation == 'UNION':
+        result = a.union( b )
+    elif operation == 'INTERSECT':
+        result = a.intersection( b )
+    elif operation == 'SUBTRACT':
+        result = a.difference( b )
+    else:
+        result = set( range( bone_count ) ).difference( a )
+
+    return sorted( result )
+
+# Side markers of bone names, and their opposites
+side_names = {
+    'L' : 'R', 'R' : 'L', 'l' : 'r', 'r' : 'l',
+    'Left' : 'Right', 'Right' : 'Left', 'left' : 'right', 'right' : 'left',
+    'LEFT' : 'RIGHT', 'RIGHT' : 'LEFT'
+}
+side_alternatives = '|'.join( sorted( side_names, key = len, reverse = True ) )
+
+# A side marker at the end of the name (before an optional .001 number),
+# or at its start, separated by a dot, underscore, dash or space
+side_suffix = re.compile( r'(?<=[._\- ])(%s)(?=([._\- ]?\d+)?$)' % side_alternatives )
+side_prefix = re.compile( r'^(%s)(?=[._\- ])' % side_alternatives )
+
+def flip_name( name ):
+    """ Return the name of a bone's opposite side (i.e. hand.L --> hand.R) """
+    flip = lambda m: side_names[ m.group( 1 ) ]
+
+    flipped = side_suffix.sub( flip, name, count = 1 )
+    if flipped == name:
+        flipped = side_prefix.sub( flip, name, count = 1 )
+
+    return flipped
+
+# Symmetry tables, keyed by armature name: ( bone names, table )
+symmetry_tables = {}
+
+def get_symmetry_table( armature ):
+    """ Return a list mapping each bone index to its opposite bone's index.
+    Center bones map to themselves. The table is only rebuilt when the
+    armature's bone names change """
+    names  = tuple( armature.bones.keys() )
+    cached = symmetry_tables.get( armature_key( armature ) )
+    if cached and cached[0] == names:
+        return cached[1]
+
+    index = dict( [ ( name, i ) for i, name in enumerate( names ) ] )
+    table = [ index.get( flip_name( name ), i ) for i, name in enumerate( names ) ]
+    symmetry_tables[ armature_key( armature ) ] = ( names, table )
+
+    return table
+
+def mirror_set( indices, table ):
+    return sorted( set( [ table[i] for i in indices if i < len( table ) ] ) )
+
+# Bone name --> index tables, keyed by armature: ( bone names, table )
+index_tables = {}
+
+def get_index_table( armature ):
+    """ Return a bone name --> index dict, only rebuilt when the armature's
+    bone names change """
+    names  = tuple( armature.bones.keys() )
+    cached = index_tables.get( armature_key( armature ) )
+    if cached and cached[0] == names:
+        return cached[1]
+
+    table = dict( [ ( name, i ) for i, name in enumerate( names ) ] )
+    index_tables[ armature_key( armature ) ] = ( names, table )
+
+    return table
+
+def remap_names( names, table ):
+    """ Map bone names to indices. Returns the indices and unmatched names """
+    indices   = []
+    unmatched = []
+    for name in names:
+        if name in table:
+            indices.append( table[ name ] )
+        else:
+            unmatched.append( name )
+
+    return indices, unmatched
+
+class bone_selection_panel( bpy.types.Panel ):
     bl_idname      = "boneSelectionPanel"
-    bl_label       = "Bone Selection Panel"
+    bl_label       = "Bone Selection Sets"
     bl_space_type  = 'VIEW_3D'
     bl_region_type = 'UI'
     bl_context     = 'posemode'
 
-    def draw( self, context) :
+    @classmethod
+    def poll( self, context ):
+        return context.object and context.object.type == 'ARMATURE'
+
+    def draw( self, context ) :
         layout = self.layout
-        layout.operator("pose.bone_selector_op")
-
-class bone_selector( bpy.types.Operator ):
-   bl_idname      = "pose.bone_selector_op"
-   bl_label       = "Select predefined bones"
-   bl_description = "Selects a group of bones for your convience"
-   bl_options     = {'REGISTER', 'UNDO' }  # Enable undo
-
-   @classmethod
-   def poll(cls, context):
-      # Find out how to check if the armature is in pose mode
-      # return context.active_object.mode == 'POSE_MODE'
-      return True
-
-   def execute( self, context):
-"""
-textfile.write(start_string) # Write constant initial string to text file
-
-# List all existing bone names
-bone_names     = [ name for bone.name in bpy.context.object.data.bones ]
-selected_bones = [ name for bone.name in bpy.context.object.data.bones if bone.select == True ]
-
-for name in bone_names:
-   # TODO:
-   # Check if you can deslect all bones via bpy operators
-   # bpy.ops.armature.select_all(action='DESELECT')
-
-   textfile.write("\t\t") # Double indent   
-
-   if name in selected_bones:
-      textfile.write("bpy.context.object.data.bones['%s'].select = True" % bone.name  + "\n")
-   else:
-      textfile.write("bpy.context.object.data.bones['%s'].select = False" % bone.name  + "\n")
+        props  = context.scene.bone_selection_props
+        obj    = context.object
+
+        row = layout.row( align = True )
+        row.prop( props, 'set_name', text = '' )
+        row.operator( 'pose.selection_set_save', icon = 'ZOOMIN' ).name = props.set_name
+
+        layout.prop( props, 'extend' )
+
+        row = layout.row( align = True )
+        row.operator( 'pose.selection_sets_import', icon = 'IMPORT' )
+        row.operator( 'pose.selection_sets_export', icon = 'EXPORT' )
+
+        if not has_selection_sets( obj ):
+            return
+
+        col = layout.column( align = True )
+        for name in sorted( get_selection_sets( obj ).keys() ):
+            row = col.row( align = True )
+            op  = row.operator( 'pose.selection_set_apply', text = name )
+            op.name   = name
+            op.extend = props.extend
+            row.operator( 'pose.selection_set_save', text = '', icon = 'FILE_REFRESH' ).name = name
+            row.operator( 'pose.selection_set_remove', text = '', icon = 'X' ).name = name
+
+        layout.separator()
+        box = layout.box()
+        box.label( "Combine sets" )
+        box.prop( props, 'operation', text = '' )
+        row = box.row( align = True )
+        row.prop( props, 'set_a', text = '' )
+        if props.operation not in ( 'INVERT', 'MIRROR' ):
+            row.prop( props, 'set_b', text = '' )
+        box.prop( props, 'result_name' )
+        box.operator( 'pose.selection_set_combine' )
+
+class selection_set_operator:
+    bl_options = {'REGISTER', 'UNDO' }
+
+    name = bpy.props.StringProperty( name = "Selection Set" )
+
+    @classmethod
+    def poll( self, context ):
+        return context.object and context.object.type == 'ARMATURE'
+
+class save_selection_set( selection_set_operator, bpy.types.Operator ):
+    """ Save the selected bones as a selection set """
+    bl_idname      = "pose.selection_set_save"
+    bl_label       = "Save Selection"
+    bl_description = "Save the selected bones as a named selection set"
+
+    def execute( self, context ):
+        if not self.name:
+            self.report( {'ERROR'}, "Selection sets need a name" )
+            return {'CANCELLED'}
+
+        obj     = context.object
+        indices = read_selection( obj.data.bones )
+        if not indices:
+            self.report( {'ERROR'}, "No bones selected" )
+            return {'CANCELLED'}
+
+        get_selection_sets( obj )[ self.name ] = indices
+
+        self.report( {'INFO'}, "Saved %d bones to %s" % ( len( indices ), self.name ) )
+        return {'FINISHED'}
+
+class apply_selection_set( selection_set_operator, bpy.types.Operator ):
+    """ Select the bones of a selection set """
+    bl_idname      = "pose.selection_set_apply"
+    bl_label       = "Select"
+    bl_description = "Select the bones of this selection set"
+
+    extend = bpy.props.BoolProperty(
+        name        = "Extend",
+        description = "Add to the current selection instead of replacing it",
+        default     = False
+    )
+
+    def execute( self, context ):
+        obj  = context.object
+        sets = get_selection_sets( obj )
+        if self.name not in sets:
+            self.report( {'ERROR'}, "No selection set named " + self.name )
+            return {'CANCELLED'}
+
+        apply_selection( obj.data.bones, sets[ self.name ], self.extend )
+
+        # Bone selection changes don't trigger a redraw by themselves
+        context.area.tag_redraw()
+        return {'FINISHED'}
+
+class remove_selection_set( selection_set_operator, bpy.types.Operator ):
+    """ Delete a selection set """
+    bl_idname      = "pose.selection_set_remove"
+    bl_label       = "Remove Selection Set"
+    bl_description = "Delete this selection set"
+
+    def execute( self, context ):
+        sets = get_selection_sets( context.object )
+        if self.name not in sets:
+            self.report( {'ERROR'}, "No selection set named " + self.name )
+            return {'CANCELLED'}
+
+        del sets[ self.name ]
+        return {'FINISHED'}
+
+class combine_selection_sets( bpy.types.Operator ):
+    """ Combine or mirror selection sets into a new set """
+    bl_idname      = "pose.selection_set_combine"
+    bl_label       = "Combine"
+    bl_description = "Combine or mirror selection sets into a new selection set, and select it"
+    bl_options     = {'REGISTER', 'UNDO' }
+
+    @classmethod
+    def poll( self, context ):
+        return has_selection_sets( context.object )
+
+    def execute( self, context ):
+        props = context.scene.bone_selection_props
+        arm   = context.object.data
+        sets  = get_selection_sets( context.object )
+
+        # Sets may have been removed since they were picked
+        needed = [ props.set_a ]
+        if props.operation not in ( 'INVERT', 'MIRROR' ):
+            needed.append( props.set_b )
+
+        if not all( [ n in sets for n in needed ] ):
+            self.report( {'ERROR'}, "Pick existing selection sets to combine" )
+            return {'CANCELLED'}
+
+        a = sets[ props.set_a ]
+        if props.operation == 'MIRROR':
+            result = mirror_set( a, get_symmetry_table( arm ) )
+        else:
+            b = sets[ props.set_b ] if props.operation != 'INVERT' else []
+            result = combine_sets( props.operation, a, b, len( arm.bones ) )
+
+        # Only touch the bones once the result is known
+        if result:
+            sets[ props.result_name ] = result
+        apply_selection( arm.bones, result )
+        context.area.tag_redraw()
+
+        self.report( {'INFO'}, "%s: %d bones" % ( props.result_name, len( result ) ) )
+        return {'FINISHED'}
+
+class export_selection_sets( bpy.types.Operator, ExportHelper ):
+    """ Save the selection sets to a file, by bone name """
+    bl_idname      = "pose.selection_sets_export"
+    bl_label       = "Export Sets"
+    bl_description = "Save the selection sets to a file, to be used on other armatures"
+    filename_ext   = ".json"
+
+    @classmethod
+    def poll( self, context ):
+        return has_selection_sets( context.object )
+
+    def execute( self, context ):
+        obj   = context.object
+        names = obj.data.bones.keys()
+        data  = {
+            'armature' : obj.data.name,
+            'sets'     : dict( [
+                ( set_name, [ names[i] for i in indices if i < len( names ) ] )
+                for set_name, indices in get_selection_sets( obj ).items()
+            ] )
+        }
+
+        with open( self.filepath, 'w' ) as f:
+            json.dump( data, f )
+
+        self.report( {'INFO'}, "Exported %d selection sets" % len( data['sets'] ) )
+        return {'FINISHED'}
+
+class import_selection_sets( bpy.types.Operator, ImportHelper ):
+    """ Load selection sets from a file, matching bones by name """
+    bl_idname      = "pose.selection_sets_import"
+    bl_label       = "Import Sets"
+    bl_description = "Load selection sets exported from this or another armature"
+    bl_options     = {'REGISTER', 'UNDO' }
+    filename_ext   = ".json"
+
+    filter_glob = bpy.props.StringProperty( default = "*.json", options = {'HIDDEN'} )
+
+    @classmethod
+    def poll( self, context ):
+        return context.object and context.object.type == 'ARMATURE'
+
+    def execute( self, context ):
+        obj = context.object
+        try:
+            with open( self.filepath ) as f:
+                data = json.load( f )
+        except ( IOError, OSError, ValueError ) as e:
+            self.report( {'ERROR'}, "Can't read selection sets: " + str( e ) )
+            return {'CANCELLED'}
+
+        table     = get_index_table( obj.data )
+        sets      = get_selection_sets( obj )
+        unmatched = set()
+        for set_name, names in data.get( 'sets', {} ).items():
+            indices, missing = remap_names( names, table )
+            unmatched.update( missing )
+            if indices:
+                sets[ set_name ] = indices
+
+        if unmatched:
+            print( "Bones not found in %s:" % obj.name, ", ".join( sorted( unmatched ) ) )
+            self.report(
+                {'WARNING'},
+                "%d bones not found (listed in the console): %s" % (
+                    len( unmatched ), ", ".join( sorted( unmatched )[:5] )
+                )
+            )
+        else:
+            self.report( {'INFO'}, "Imported %d selection sets" % len( data.get( 'sets', {} ) ) )
+
+        return {'FINISHED'}
+
+# Keep a reference to the enum items, blender doesn't keep them alive
+set_name_items = []
+
+def list_selection_sets( self, context ):
+    """ Enum items of the selection set names. Enum properties store the
+    item number, so number items by name: a picked set stays picked when
+    other sets are saved or removed, and reads as '' once it's removed """
+    del set_name_items[:]
+    obj = context.object
+    if has_selection_sets( obj ):
+        set_name_items.extend( [
+            ( name, name, '', 'NONE', zlib.crc32( name.encode( 'utf-8' ) ) & 0x7fffffff )
+            for name in sorted( get_selection_sets( obj ).keys() )
+        ] )
+    return set_name_items
+
+class bone_selection_options( bpy.types.PropertyGroup ):
+    operations = [
+        ( 'UNION',     'Union',     'Bones in either set' ),
+        ( 'INTERSECT', 'Intersect', 'Bones in both sets' ),
+        ( 'SUBTRACT',  'Subtract',  'Bones in the first set but not in the second' ),
+        ( 'INVERT',    'Invert',    'Bones not in the set' ),
+        ( 'MIRROR',    'Mirror',    'The opposite side bones of the set' )
+    ]
+
+    operation = bpy.props.EnumProperty(
+        description = "How to combine the selection sets",
+        name        = "Operation",
+        items       = operations,
+        default     = 'UNION'
+    )
+
+    set_a = bpy.props.EnumProperty(
+        description = "First selection set",
+        name        = "Set A",
+        items       = list_selection_sets
+    )
+
+    set_b = bpy.props.EnumProperty(
+        description = "Second selection set",
+        name        = "Set B",
+        items       = list_selection_sets
+    )
+
+    result_name = bpy.props.StringProperty(
+        description = "Name of the selection set holding the result",
+        name        = "Result",
+        default     = "Combined"
+    )
+
+    set_name = bpy.props.StringProperty(
+        description = "Name of the selection set to save",
+        name        = "Name",
+        default     = "Selection"
+    )
+
+    extend = bpy.props.BoolProperty(
+        description = "Add selection sets to the current selection instead of replacing it",
+        name        = "Extend Selection",
+        default     = False
+    )
+
+def register():
+    bpy.utils.register_module(__name__)
+    bpy.types.Scene.bone_selection_props = bpy.props.PointerProperty(
+        type = bone_selection_options
+    )
+
+def unregister():
+    bpy.utils.unregister_module(__name__)
+
+if __name__ == "__main__":
+    register()
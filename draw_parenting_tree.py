@@ -140,4 +140,218 @@ for bone in bones:
             if not subtarget_node.inputs[i].links:
                 break
 
-        links.new(cnode.outputs[0],subtarget_node.inputs[i])
\ No newline at end of file
+        links.new(cnode.outputs[0],subtarget_node.inputs[i])
+
+# Analyse the dependency graph formed by parenting and constraints
+# Set to False to only print the report without coloring the tree's nodes
+COLOR_NODES     = True
+FAN_IN_WARNING  = 3    # Constraint dependencies above which a bone is flagged
+REPORT_LENGTH   = 20   # Number of bones listed in the ranked report
+
+cycle_color     = ( 1.0, 0.1, 0.1 )
+critical_color  = ( 1.0, 0.5, 0.0 )
+fan_in_color    = ( 0.9, 0.9, 0.1 )
+
+def get_constraint_targets( pbone ):
+    """ Return the names of the bones (in this rig) that a pose bone's
+    constraints depend on """
+    targets = []
+    for const in pbone.constraints:
+        # Multi target constraints (i.e. Armature) keep a list of targets
+        const_targets = getattr( const, 'targets', None )
+        if const_targets is None:
+            const_targets = [ const ]
+
+        for t in const_targets:
+            target    = getattr( t, 'target',    None )
+            subtarget = getattr( t, 'subtarget', ''   )
+            if target == rig and subtarget in pb:
+                targets.append( subtarget )
+
+    return targets
+
+def build_dependency_graph():
+    """ Map each bone to the bones it depends on (its parent and its constraint
+    subtargets), along with the number of constraint dependencies of each bone """
+    deps   = {}
+    fan_in = {}
+    for pbone in pb:
+        targets            = get_constraint_targets( pbone )
+        fan_in[pbone.name] = len( pbone.constraints ) + len( targets )
+
+        deps[pbone.name] = set( targets )
+        if pbone.parent:
+            deps[pbone.name].add( pbone.parent.name )
+
+        deps[pbone.name].discard( pbone.name )
+
+    return deps, fan_in
+
+def find_cycles( deps ):
+    """ Tarjan's strongly connected components algorithm (iterative to avoid
+    hitting the recursion limit on big rigs). Returns a list of components
+    containing more than a single bone - i.e. dependency cycles """
+    index    = {}
+    lowlink  = {}
+    on_stack = set()
+    stack    = []
+    cycles   = []
+    counter  = 0
+
+    for start in deps:
+        if start in index:
+            continue
+
+        work = [ ( start, iter( deps[start] ) ) ]
+        index[start] = lowlink[start] = counter
+        counter += 1
+        stack.append( start )
+        on_stack.add( start )
+
+        while work:
+            bone, children = work[-1]
+            advanced = False
+            for dep in children:
+                if dep not in index:
+                    index[dep] = lowlink[dep] = counter
+                    counter += 1
+                    stack.append( dep )
+                    on_stack.add( dep )
+                    work.append( ( dep, iter( deps[dep] ) ) )
+                    advanced = True
+                    break
+                elif dep in on_stack:
+                    lowlink[bone] = min( lowlink[bone], index[dep] )
+
+            if advanced:
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min( lowlink[parent], lowlink[bone] )
+
+            if lowlink[bone] == index[bone]:
+                component = []
+                while True:
+                    b = stack.pop()
+                    on_stack.discard( b )
+                    component.append( b )
+                    if b == bone:
+                        break
+                if len( component ) > 1:
+                    cycles.append( component )
+
+    return cycles
+
+def evaluation_depth( deps, cyclic ):
+    """ Compute each bone's evaluation depth (the length of the longest chain
+    of dependencies that must be evaluated before it) and the bone preceding
+    it on that chain. Bones in cycles are treated as roots, since their order
+    is undefined anyway """
+    depth    = {}
+    previous = {}
+
+    for start in deps:
+        if start in depth:
+            continue
+
+        stack = [ start ]
+        while stack:
+            bone    = stack[-1]
+            pending = [ d for d in deps[bone] if d not in depth ]
+            if pending and bone not in cyclic:
+                stack.extend( pending )
+                continue
+
+            stack.pop()
+            if bone in depth:
+                continue
+
+            depth[bone]    = 0
+            previous[bone] = None
+            if bone in cyclic:
+                continue
+
+            for d in deps[bone]:
+                if depth[d] + 1 > depth[bone]:
+                    depth[bone]    = depth[d] + 1
+                    previous[bone] = d
+
+    return depth, previous
+
+def count_dependents( deps ):
+    """ Count how many bones (directly) depend on each bone """
+    dependents = dict.fromkeys( deps, 0 )
+    for bone in deps:
+        for d in deps[bone]:
+            dependents[d] += 1
+    return dependents
+
+def color_node( name, color ):
+    if name in tree.nodes:
+        node                  = tree.nodes[name]
+        node.color            = color
+        node.use_custom_color = True
+
+def analyse_dependencies():
+    deps, fan_in = build_dependency_graph()
+    cycles       = find_cycles( deps )
+    cyclic       = set( b for c in cycles for b in c )
+    depth, prev  = evaluation_depth( deps, cyclic )
+    dependents   = count_dependents( deps )
+
+    # Walk back from the deepest bone to find the critical chain
+    chain = []
+    if depth:
+        bone = max( depth, key = lambda b: depth[b] )
+        while bone:
+            chain.append( bone )
+            bone = prev[bone]
+        chain.reverse()
+
+    # Rank bones by the cost they're likely to add to pose evaluation:
+    # bones with many constraint dependencies that sit deep in the chain
+    # and have other bones waiting on them are the expensive ones
+    scores = {
+        b : fan_in[b] * ( 1 + depth[b] ) * ( 1 + dependents[b] ) for b in deps
+    }
+    ranked = sorted(
+        [ b for b in scores if scores[b] > 0 ],
+        key     = lambda b: scores[b],
+        reverse = True
+    )
+    flagged = [ b for b in ranked if fan_in[b] > FAN_IN_WARNING ]
+
+    print( "\n=== Dependency report for", rig.name, "===" )
+    print( "Bones:", len( deps ), " Max depth:", max( depth.values() or [0] ) )
+
+    print( "\nDependency cycles:", len( cycles ) )
+    for c in cycles:
+        print( "  ", " <-> ".join( sorted( c ) ) )
+
+    print( "\nCritical chain (", len( chain ), "bones ):" )
+    print( "  ", " --> ".join( chain ) )
+
+    print( "\nMost expensive bones:" )
+    print( "   %-32s %6s %6s %6s %8s" % (
+        'bone', 'fan-in', 'depth', 'deps', 'score'
+    ) )
+    for b in ranked[:REPORT_LENGTH]:
+        flag = '!' if b in flagged else ' '
+        print( " %s %-32s %6d %6d %6d %8d" % (
+            flag, b, fan_in[b], depth[b], dependents[b], scores[b]
+        ) )
+
+    if COLOR_NODES:
+        # Paint in reverse order of importance so cycles win over the rest
+        for b in flagged:
+            color_node( b, fan_in_color )
+        for b in chain:
+            color_node( b, critical_color )
+        for b in cyclic:
+            color_node( b, cycle_color )
+
+    return cycles, chain, ranked
+
+analyse_dependencies()
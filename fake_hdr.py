@@ -45,14 +45,20 @@ bl_info = {
     "description" : "Create an array of lamps that mimicks an HDR image"
 }
 
-import bpy, re, bmesh, math
+import bpy, re, bmesh, math, os, struct, hashlib, array
 from collections import defaultdict
-from mathutils   import Color
+from mathutils   import Color, Vector
 
 def check_poll_conditions( context ):
+    props               = context.scene.fake_hdr_props
     hdr_image_selected  = context.scene.fake_hdr_image
     render_engine_is_bi = context.scene.render.engine == 'BLENDER_RENDER'
-    return hdr_image_selected and render_engine_is_bi
+    # Only baking needs blender internal, sampling reads the image directly
+    needs_bake = props.placement_method == 'ICOSPHERE_BAKE'
+    # Emitter meshes are lit by a cycles material
+    needs_cycles = props.output_mode == 'CYCLES_MESH'
+    return hdr_image_selected and ( render_engine_is_bi or not needs_bake ) and \
+           ( context.scene.render.engine == 'CYCLES' or not needs_cycles )
 
 def change_light_intensity( obj, intensity ):
     """ Change the light intensity of a lamp. Uses the correct methods to 
@@ -65,6 +71,23 @@ def change_light_intensity( obj, intensity ):
     else:
         obj.data.energy = intensity
 
+def get_light_intensity( obj ):
+    """ Read a lamp's light intensity, counterpart of change_light_intensity """
+    if bpy.context.scene.render.engine == 'CYCLES' and obj.data.use_nodes:
+        return obj.data.node_tree.nodes['Emission'].inputs['Strength'].default_value
+    return obj.data.energy
+
+def luminance( color ):
+    return 0.2126 * color[0] + 0.7152 * color[1] + 0.0722 * color[2]
+
+def normalize_color( color ):
+    """ Split a color into a color with a peak of 1 and an intensity (the
+    peak), so that color x intensity is the original color """
+    peak = max( color )
+    if peak <= 0:
+        return ( 0.0, 0.0, 0.0 ), 0.0
+    return tuple( [ c / peak for c in color ] ), peak
+
 def sort_by_value( colors, sorted_list, calls ):
     """ Recursive sorting algorithm meant to find the smallest to highest
         color values in a list of averaged vertex colors """
@@ -90,6 +113,988 @@ def sort_by_value( colors, sorted_list, calls ):
         return sorted_list
     else:
         return sort_by_value( colors, sorted_list, calls + 1 )
+
+# Lamp analysis cache. Results are saved in a binary sidecar next to the HDR
+# image (<image>.fakehdr), so any blend file using the same image reuses them.
+# Layout: magic, version, sha1 of the image file, entry count, then for each
+# entry its key ("<num_of_lamps>:<placement method>"), lamp count and 7 floats
+# per lamp: location xyz, color rgb (normalized, see normalize_color), intensity
+cache_magic     = b'FHDR'
+cache_version   = 2
+cache_extension = '.fakehdr'
+lamp_format     = '<7f'
+lamp_size       = struct.calcsize( lamp_format )
+
+# Hashes of image files: path --> ( ( mtime, size ), sha1 digest )
+image_hashes = {}
+
+# Sidecar entries already read in this session: path --> ( digest, entries )
+lamp_cache = {}
+
+def get_image_path( image ):
+    """ Return the absolute path of an image's file, or None if it has none """
+    if not image or image.source != 'FILE' or image.packed_file:
+        return None
+
+    path = bpy.path.abspath( image.filepath )
+    return path if os.path.isfile( path ) else None
+
+def hash_image_file( path ):
+    """ sha1 of an image file's contents, only recomputed if the file changed """
+    stat  = os.stat( path )
+    stamp = ( stat.st_mtime, stat.st_size )
+    if path in image_hashes and image_hashes[ path ][0] == stamp:
+        return image_hashes[ path ][1]
+
+    sha1 = hashlib.sha1()
+    with open( path, 'rb' ) as f:
+        for chunk in iter( lambda: f.read( 1 << 20 ), b'' ):
+            sha1.update( chunk )
+
+    image_hashes[ path ] = ( stamp, sha1.digest() )
+    return sha1.digest()
+
+def get_cache_key( num_of_lamps, method ):
+    return "%d:%s" % ( num_of_lamps, method )
+
+def read_lamp_cache( path ):
+    """ Read a sidecar file. Returns ( image digest, { key : lamps } ) """
+    with open( path, 'rb' ) as f:
+        data = f.read()
+
+    magic, version, digest, count = struct.unpack_from( '<4sH20sI', data )
+    if magic != cache_magic or version != cache_version:
+        return None, {}
+
+    offset  = struct.calcsize( '<4sH20sI' )
+    entries = {}
+    for e in range( count ):
+        key_len, = struct.unpack_from( '<H', data, offset )
+        offset  += 2
+        key      = data[ offset : offset + key_len ].decode( 'utf-8' )
+        offset  += key_len
+
+        lamp_count, = struct.unpack_from( '<I', data, offset )
+        offset     += 4
+
+        lamps = []
+        for l in range( lamp_count ):
+            values = struct.unpack_from( lamp_format, data, offset )
+            offset += lamp_size
+            lamps.append( ( values[0:3], values[3:6], values[6] ) )
+
+        entries[ key ] = lamps
+
+    return digest, entries
+
+def write_lamp_cache( path, digest, entries ):
+    chunks = [ struct.pack( '<4sH20sI', cache_magic, cache_version, digest, len( entries ) ) ]
+    for key, lamps in entries.items():
+        key = key.encode( 'utf-8' )
+        chunks.append( struct.pack( '<H', len( key ) ) + key )
+        chunks.append( struct.pack( '<I', len( lamps ) ) )
+        for location, color, intensity in lamps:
+            chunks.append(
+                struct.pack( lamp_format, *( tuple( location ) + tuple( color ) + ( intensity, ) ) )
+            )
+
+    with open( path, 'wb' ) as f:
+        f.write( b''.join( chunks ) )
+
+def get_cached_entries( image_path ):
+    """ Return the image's digest and its cached entries (a dict that can be
+    updated and written back with store_cached_lamps) """
+    digest = hash_image_file( image_path )
+    path   = image_path + cache_extension
+
+    if path in lamp_cache and lamp_cache[ path ][0] == digest:
+        return digest, lamp_cache[ path ][1]
+
+    entries = {}
+    if os.path.isfile( path ):
+        try:
+            cached_digest, cached_entries = read_lamp_cache( path )
+            # Results for a previous version of the image are discarded
+            if cached_digest == digest:
+                entries = cached_entries
+        except ( IOError, OSError, struct.error, UnicodeDecodeError ) as e:
+            print( "Fake HDR: ignoring unreadable cache", path, e )
+
+    lamp_cache[ path ] = ( digest, entries )
+    return digest, entries
+
+def load_cached_lamps( image, num_of_lamps, method ):
+    """ Return the cached lamps ( location, color, intensity ) for this image
+    and settings, or None if they haven't been computed yet """
+    image_path = get_image_path( image )
+    if not image_path:
+        return None
+
+    digest, entries = get_cached_entries( image_path )
+    return entries.get( get_cache_key( num_of_lamps, method ) )
+
+def store_cached_lamps( image, num_of_lamps, method, lamps ):
+    image_path = get_image_path( image )
+    if not image_path:
+        return
+
+    digest, entries = get_cached_entries( image_path )
+    entries[ get_cache_key( num_of_lamps, method ) ] = lamps
+
+    try:
+        write_lamp_cache( image_path + cache_extension, digest, entries )
+    except ( IOError, OSError ) as e:
+        print( "Fake HDR: can't write cache", image_path + cache_extension, e )
+
+# Mip pyramid of the HDR image, for sampling lamps without baking. The finest
+# level is the image scaled down (in C, with Image.scale) to the largest of
+# these widths it has, and read back once. Each coarser level is averaged
+# from the level above it, so the full resolution image is copied only once.
+mip_widths = ( 64, 128, 256, 512, 1024 )
+
+# image name --> ( ( filepath, size ), { width : ( width, height, pixels ) } )
+mip_pyramids = {}
+
+def read_pixels( image ):
+    """ Read an image's RGBA floats, in bulk where supported """
+    pixels = image.pixels
+    if hasattr( pixels, 'foreach_get' ):
+        data = array.array( 'f', bytes( 4 * len( pixels ) ) )
+        pixels.foreach_get( data )
+        return data
+
+    return pixels[:]
+
+def downsample( level ):
+    """ Halve a level with a 2x2 box filter """
+    width, height, pixels = level
+    w, h = max( 1, width // 2 ), max( 1, height // 2 )
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    if numpy and width > 1 and height > 1:
+        px = numpy.asarray( pixels, dtype = numpy.float32 ).reshape( height, width, 4 )
+        px = px[ : h * 2, : w * 2 ].reshape( h, 2, w, 2, 4 ).mean( axis = ( 1, 3 ) )
+        return ( w, h, array.array( 'f', px.astype( numpy.float32 ).tobytes() ) )
+
+    out = array.array( 'f', bytes( 4 * w * h * 4 ) )
+    for row in range( h ):
+        r0 = min( 2 * row,     height - 1 ) * width
+        r1 = min( 2 * row + 1, height - 1 ) * width
+        for col in range( w ):
+            c0 = min( 2 * col,     width - 1 )
+            c1 = min( 2 * col + 1, width - 1 )
+            o  = ( row * w + col ) * 4
+            for k in range( 4 ):
+                out[ o + k ] = (
+                    pixels[ ( r0 + c0 ) * 4 + k ] + pixels[ ( r0 + c1 ) * 4 + k ] +
+                    pixels[ ( r1 + c0 ) * 4 + k ] + pixels[ ( r1 + c1 ) * 4 + k ]
+                ) / 4
+
+    return ( w, h, out )
+
+def get_mip_level( image, width ):
+    """ Return ( width, height, pixels ) of the pyramid level closest to (and
+    not narrower than) width, computing each level only once per image """
+    stamp = ( image.filepath, tuple( image.size ) )
+    if image.name not in mip_pyramids or mip_pyramids[ image.name ][0] != stamp:
+        mip_pyramids[ image.name ] = ( stamp, {} )
+
+    levels = mip_pyramids[ image.name ][1]
+    top    = max( [ w for w in mip_widths if w <= image.size[0] ] or [ image.size[0] ] )
+    if top not in levels:
+        if top == image.size[0]:
+            levels[ top ] = ( image.size[0], image.size[1], read_pixels( image ) )
+        else:
+            height = max( 1, top * image.size[1] // image.size[0] )
+            copy   = image.copy()
+            copy.scale( top, height )
+            levels[ top ] = ( top, height, read_pixels( copy ) )
+            bpy.data.images.remove( copy )
+
+    # Halve down from the finest level
+    level = top
+    while level // 2 >= max( width, 1 ):
+        if level // 2 not in levels:
+            levels[ level // 2 ] = downsample( levels[ level ] )
+        level //= 2
+
+    return levels[ level ]
+
+def candidate_count( n ):
+    """ Number of candidate lamp positions for n lamps, the same as the
+    number of verts of the icosphere the bake method would use """
+    subd = math.ceil( math.log( ( n - 2 ) / 2.5, 4 ) )
+    return int( 2.5 * 4 ** subd ) + 2
+
+def footprint_radius( count ):
+    """ Angular radius of the region each of count evenly spread lamps covers """
+    return math.acos( 1 - 2 / count )
+
+def fibonacci_directions( count ):
+    """ count unit vectors spread evenly over the sphere """
+    golden     = math.pi * ( 3 - math.sqrt( 5 ) )
+    directions = []
+    for i in range( count ):
+        z = 1 - ( 2 * i + 1 ) / count
+        r = math.sqrt( 1 - z * z )
+        directions.append( ( r * math.cos( golden * i ), r * math.sin( golden * i ), z ) )
+
+    return directions
+
+# Equirectangular mapping, the same as blender's environment textures:
+# u = 0.5 - atan2( y, x ) / 2pi, v = 0.5 + asin( z ) / pi, so the image's
+# center looks down +X. Longitude and latitude here are ( u - 0.5 ) * 2pi and
+# ( v - 0.5 ) * pi
+def direction_to_lon_lat( d ):
+    """ Equirectangular longitude and latitude of a direction """
+    return -math.atan2( d[1], d[0] ), math.asin( max( -1.0, min( 1.0, d[2] ) ) )
+
+def lon_lat_to_direction( lon, lat ):
+    """ Unit direction of an equirectangular longitude and latitude """
+    return ( math.cos( lat ) * math.cos( lon ), -math.cos( lat ) * math.sin( lon ), math.sin( lat ) )
+
+def region_color( pixels, width, height, lon, lat, radius ):
+    """ Average color of the image around ( lon, lat ), weighting each pixel
+    by its solid angle """
+    row_min = max( 0,          int( ( ( lat - radius ) / math.pi + 0.5 ) * height ) )
+    row_max = min( height - 1, int( ( ( lat + radius ) / math.pi + 0.5 ) * height ) )
+
+    r = g = b = weight = 0.0
+    for row in range( row_min, row_max + 1 ):
+        cos_lat = math.cos( ( ( row + 0.5 ) / height - 0.5 ) * math.pi )
+
+        # The region spans more columns towards the poles
+        half = radius / max( cos_lat, 1e-3 )
+        if half >= math.pi:
+            cols = range( width )
+        else:
+            c0   = int( math.floor( ( ( lon - half ) / ( 2 * math.pi ) + 0.5 ) * width ) )
+            c1   = int( math.floor( ( ( lon + half ) / ( 2 * math.pi ) + 0.5 ) * width ) )
+            cols = [ c % width for c in range( c0, c1 + 1 ) ]
+
+        start = row * width
+        for col in cols:
+            i       = ( start + col ) * 4
+            r      += pixels[ i     ] * cos_lat
+            g      += pixels[ i + 1 ] * cos_lat
+            b      += pixels[ i + 2 ] * cos_lat
+            weight += cos_lat
+
+    if not weight:
+        return ( 0.0, 0.0, 0.0 )
+
+    return ( r / weight, g / weight, b / weight )
+
+def make_lamp_data( samples, n ):
+    """ Keep the n brightest ( direction, color ) samples, as ( location,
+    color, intensity ) from the darkest to the brightest. Colors are
+    normalized, color x intensity is the sampled color """
+    samples = sorted( samples, key = lambda s: sum( s[1] ) )[ -n: ]
+
+    return [
+        ( direction, ) + normalize_color( color ) for direction, color in samples
+    ]
+
+def sample_lamps( level, directions, n, pixel_budget = 65536 ):
+    """ Generator sampling the lamps from a mip level. Yields None every
+    pixel_budget pixels, so the work can be spread over timer events, and
+    finally the lamp data """
+    width, height, pixels = level
+    radius  = footprint_radius( len( directions ) )
+    batch   = max( 1, len( directions ) * pixel_budget // ( width * height ) )
+    samples = []
+    for i, d in enumerate( directions ):
+        lon, lat = direction_to_lon_lat( d )
+        samples.append( ( d, region_color( pixels, width, height, lon, lat, radius ) ) )
+        if i % batch == batch - 1:
+            yield None
+
+    yield make_lamp_data( samples, n )
+
+def run_to_end( job ):
+    """ Run a sampling generator to completion and return its result """
+    for result in job:
+        if result is not None:
+            return result
+
+def get_refine_levels( image, n ):
+    """ Mip level widths to sample n lamps at, from the preview level (where a
+    pixel is about the size of a lamp's region) up to the finest level """
+    radius    = footprint_radius( candidate_count( n ) )
+    max_width = min( mip_widths[-1], image.size[0] )
+    levels    = [
+        w for w in mip_widths if w <= max_width and 2 * math.pi / w <= radius * 2
+    ]
+
+    return levels or [ max_width ]
+
+def remove_objects( scene, objs ):
+    """ Delete objects along with their lamp or mesh data """
+    for obj in objs:
+        data = obj.data
+        scene.objects.unlink( obj )
+        bpy.data.objects.remove( obj )
+
+        if data and not data.users:
+            if obj.type == 'LAMP':
+                bpy.data.lamps.remove( data )
+            elif obj.type == 'MESH':
+                bpy.data.meshes.remove( data )
+
+def remove_rig( context ):
+    """ Delete the light array control empty, its lamps and sphere """
+    empty = context.scene.objects.get( 'FakeHDR.LightArray.Control' )
+    if empty:
+        remove_objects( context.scene, list( empty.children ) + [ empty ] )
+
+# Each lamp stores the solid angle (in steradians) of the part of the HDR it
+# stands for, and the control empty the solid angle of a single region, so
+# lamps merged from several regions keep their share of the light
+def lamp_weight( lamp ):
+    """ Number of regions (of the original rig) a lamp stands for """
+    empty = lamp.parent
+    if not empty or 'fake_hdr_solid_angle' not in empty:
+        return 1.0
+    return lamp.get( 'fake_hdr_solid_angle', empty[ 'fake_hdr_solid_angle' ] ) / \
+           empty[ 'fake_hdr_solid_angle' ]
+
+def set_lamp_energy( lamp, value ):
+    """ Set a lamp's energy to value (the rig's lamp_intensity) scaled by the
+    HDR intensity it was sampled with and the regions it stands for """
+    change_light_intensity(
+        lamp, value * lamp.get( 'fake_hdr_intensity', 1.0 ) * lamp_weight( lamp )
+    )
+
+def lamp_contribution( lamp ):
+    """ Estimated contribution of a lamp to the scene's light: intensity (per
+    steradian) x color luminance x solid angle, i.e. energy x luminance """
+    return get_light_intensity( lamp ) * luminance( lamp.data.color )
+
+def lamp_render_cost( lamp ):
+    """ Rough relative shading cost of a lamp: one unit for its lighting plus
+    its shadow samples """
+    data = lamp.data
+    if data.shadow_method == 'RAY_SHADOW':
+        samples = data.shadow_ray_samples if data.shadow_soft_size > 0 else 1
+        return 1 + samples * samples
+    if data.shadow_method == 'BUFFER_SHADOW':
+        return 1 + data.shadow_buffer_samples * int( data.shadow_sample_buffers )
+    return 1
+
+def rig_stats( lamps ):
+    """ Return ( lamp count, shadow casters, estimated cost, total contribution ) """
+    return (
+        len( lamps ),
+        len( [ l for l in lamps if l.data.shadow_method != 'NOSHADOW' ] ),
+        sum( [ lamp_render_cost( l )  for l in lamps ] ),
+        sum( [ lamp_contribution( l ) for l in lamps ] )
+    )
+
+def merge_lamps( keep, lamps ):
+    """ Merge lamps into keep: its direction and color become the contribution
+    weighted averages and its solid angle and energy the sums """
+    group   = [ keep ] + lamps
+    weights = [ lamp_contribution( l ) or 1e-6 for l in group ]
+    total   = sum( weights )
+
+    direction = [ 0.0, 0.0, 0.0 ]
+    color     = [ 0.0, 0.0, 0.0 ]
+    for l, w in zip( group, weights ):
+        d = l.location.normalized()
+        for i in range( 3 ):
+            direction[i] += d[i] * w / total
+            color[i]     += l.data.color[i] * w / total
+
+    radius = keep.location.length
+    length = math.sqrt( sum( [ c * c for c in direction ] ) ) or 1
+    energy = sum( [ get_light_intensity( l ) * luminance( l.data.color ) for l in group ] )
+
+    keep.location   = [ c / length * radius for c in direction ]
+    keep.data.color = color
+    energy          = energy / ( luminance( color ) or 1 )
+    change_light_intensity( keep, energy )
+
+    if 'fake_hdr_solid_angle' in keep.parent:
+        keep[ 'fake_hdr_solid_angle' ] = sum(
+            [ lamp_weight( l ) for l in group ]
+        ) * keep.parent[ 'fake_hdr_solid_angle' ]
+
+    # Keep the merged energy through later intensity updates (set_lamp_energy)
+    base = bpy.context.scene.fake_hdr_props.lamp_intensity * lamp_weight( keep )
+    if base:
+        keep[ 'fake_hdr_intensity' ] = energy / base
+
+def index_lamps( lamps, suns ):
+    """ Number lamps in brightness order for apply_lamp_data. Suns are left
+    out, refining must not move them to a regular lamp's direction """
+    for i, l in enumerate( lamps ):
+        l[ 'fake_hdr_index' ] = i
+    for l in suns:
+        if 'fake_hdr_index' in l:
+            del l[ 'fake_hdr_index' ]
+
+def apply_lamp_data( context, lamp_data ):
+    """ Move, recolor and set the energy of the existing rig's lamps to the
+    refined lamp data """
+    empty = context.scene.objects[ 'FakeHDR.LightArray.Control' ]
+    lamps = sorted(
+        [ c for c in empty.children if 'fake_hdr_index' in c ],
+        key = lambda l: l[ 'fake_hdr_index' ]
+    )
+
+    value = context.scene.fake_hdr_props.lamp_intensity
+    for lamp, ( location, color, intensity ) in zip( lamps, lamp_data ):
+        lamp.location   = location
+        lamp.data.color = color
+        lamp[ 'fake_hdr_intensity' ] = intensity
+        set_lamp_energy( lamp, value )
+
+    emitter = context.scene.objects.get( empty.get( 'fake_hdr_emitter', '' ) )
+    if emitter:
+        build_emitter_mesh(
+            emitter.data, lamp_data, empty[ 'fake_hdr_solid_angle' ],
+            context.scene.fake_hdr_props.emitter_distance
+        )
+
+        # The rebuilt mesh has a new face nearest to the sun
+        if empty.get( 'fake_hdr_sun_lamp', '' ) in context.scene.objects:
+            find_sun_face( empty, emitter )
+            set_sun_face_enabled( empty, emitter, not context.scene.fake_hdr_props.use_sun )
+
+# Cycles output: instead of lamps, one mesh with a small hexagonal emitter
+# facing the center for each region of the HDR, with an area matching the
+# region's solid angle at emitter_distance. All emitters share one material,
+# their color is a vertex color layer and their strength the U coordinate of
+# a UV layer, so one node tree serves the whole rig and cycles (light tree)
+# samples it as a single mesh light
+emitter_material = 'FakeHDR.Emitter'
+emitter_color    = 'FakeHDR.Color'
+emitter_strength = 'FakeHDR.Strength'
+emitter_sides    = 6
+
+def linear_to_srgb( c ):
+    """ sRGB encode a linear color component in 0 - 1 """
+    if c <= 0.0031308:
+        return 12.92 * c
+    return 1.055 * c ** ( 1 / 2.4 ) - 0.055
+
+def build_emitter_mesh( me, lamp_data, region, distance ):
+    """ Fill a mesh with one emitter face per lamp, replacing its geometry """
+    bm          = bmesh.new()
+    color_layer = bm.loops.layers.color.new( emitter_color )
+    uv_layer    = bm.loops.layers.uv.new( emitter_strength )
+
+    # Circumradius of a hexagon with an area of region x distance ^ 2
+    area   = region * distance ** 2
+    radius = math.sqrt( area / ( emitter_sides / 2 * math.sin( 2 * math.pi / emitter_sides ) ) )
+    angles = [ 2 * math.pi * i / emitter_sides for i in range( emitter_sides ) ]
+
+    for direction, color, intensity in lamp_data:
+        d         = Vector( direction ).normalized()
+        tangent   = d.orthogonal().normalized()
+        bitangent = d.cross( tangent )
+        center    = d * distance
+
+        verts = [
+            bm.verts.new( center + ( tangent * math.cos( a ) + bitangent * math.sin( a ) ) * radius )
+            for a in angles
+        ]
+        face = bm.faces.new( verts )
+
+        # Emit towards the center
+        face.normal_update()
+        if face.normal.dot( d ) > 0:
+            face.normal_flip()
+
+        # Colors are normalized, the strength (emitted radiance in cycles)
+        # restores the region's radiance. Byte vertex colors are read as
+        # sRGB, so the linear color is encoded
+        srgb = tuple( [ linear_to_srgb( c ) for c in color ] )
+        for loop in face.loops:
+            loop[ color_layer ] = srgb + ( 1.0, ) * ( len( loop[ color_layer ] ) - 3 )
+            loop[ uv_layer ].uv = ( intensity, 0.0 )
+
+    bm.to_mesh( me )
+    bm.free()
+    me.update()
+
+def emitter_face_strength( me, index, strength = None ):
+    """ Return an emitter face's strength (the U of its UVs), setting it first
+    if a strength is given """
+    uvs   = me.uv_layers[ emitter_strength ].data
+    loops = me.polygons[ index ].loop_indices
+    if strength is not None:
+        for l in loops:
+            uvs[ l ].uv = ( strength, 0.0 )
+
+    return uvs[ loops[0] ].uv[0]
+
+def find_sun_face( empty, emitter ):
+    """ Find the emitter face nearest to the sun (the sun lamp's twin), and
+    remember it and its strength on the control empty """
+    me  = emitter.data
+    sun = empty.get( 'fake_hdr_sun' )
+    if not sun or not len( me.polygons ):
+        return
+
+    d     = Vector( sun['direction'] )
+    index = max(
+        range( len( me.polygons ) ), key = lambda i: d.dot( me.polygons[i].center.normalized() )
+    )
+    empty[ 'fake_hdr_sun_face' ]          = index
+    empty[ 'fake_hdr_sun_face_strength' ] = emitter_face_strength( me, index )
+
+def set_sun_face_enabled( empty, emitter, enabled ):
+    """ Turn the sun's emitter face off while the sun lamp lights its region """
+    if 'fake_hdr_sun_face' not in empty:
+        return
+
+    strength = empty[ 'fake_hdr_sun_face_strength' ] if enabled else 0.0
+    emitter_face_strength( emitter.data, empty[ 'fake_hdr_sun_face' ], strength )
+    emitter.data.update()
+
+def new_node( nodes, *types ):
+    """ Create a node of the first of these types this blender version has """
+    for node_type in types[:-1]:
+        try:
+            return nodes.new( node_type )
+        except RuntimeError:
+            pass
+    return nodes.new( types[-1] )
+
+def get_emitter_material( strength ):
+    """ Return the shared emitter material, creating it if needed """
+    mat = bpy.data.materials.get( emitter_material )
+    if mat:
+        mat.node_tree.nodes[ emitter_strength ].inputs[1].default_value = strength
+        return mat
+
+    mat           = bpy.data.materials.new( emitter_material )
+    mat.use_nodes = True
+    nodes         = mat.node_tree.nodes
+    links         = mat.node_tree.links
+    for node in list( nodes ):
+        nodes.remove( node )
+
+    color                = nodes.new( 'ShaderNodeAttribute' )
+    color.attribute_name = emitter_color
+    uv                   = nodes.new( 'ShaderNodeAttribute' )
+    uv.attribute_name    = emitter_strength
+    split                = new_node( nodes, 'ShaderNodeSeparateXYZ', 'ShaderNodeSeparateRGB' )
+    scale                = nodes.new( 'ShaderNodeMath' )
+    scale.name           = emitter_strength
+    scale.operation      = 'MULTIPLY'
+    emission             = nodes.new( 'ShaderNodeEmission' )
+    output               = nodes.new( 'ShaderNodeOutputMaterial' )
+
+    scale.inputs[1].default_value = strength
+
+    links.new( color.outputs['Color'],   emission.inputs['Color']    )
+    links.new( uv.outputs['Vector'],     split.inputs[0]             )
+    links.new( split.outputs[0],         scale.inputs[0]             )
+    links.new( scale.outputs[0],         emission.inputs['Strength'] )
+    links.new( emission.outputs[0],      output.inputs['Surface']    )
+
+    for x, node in enumerate( [ uv, split, scale, emission, output ] ):
+        node.location = ( x * 200, 0 )
+    color.location = ( 400, 200 )
+
+    # Let cycles sample the emitters as lights (only their front faces emit)
+    settings = getattr( mat, 'cycles', None )
+    if hasattr( settings, 'emission_sampling' ):
+        settings.emission_sampling = 'FRONT'
+    elif hasattr( settings, 'sample_as_light' ):
+        settings.sample_as_light = True
+
+    return mat
+
+def create_emitters( context, empty, lamp_data ):
+    """ Create the cycles emitter mesh for the lamp data """
+    props = context.scene.fake_hdr_props
+    me    = bpy.data.meshes.new( 'FakeHDR.Emitters' )
+    build_emitter_mesh( me, lamp_data, empty[ 'fake_hdr_solid_angle' ], props.emitter_distance )
+    me.materials.append( get_emitter_material( props.lamp_intensity ) )
+
+    obj = bpy.data.objects.new( 'FakeHDR.Emitters', me )
+    context.scene.objects.link( obj )
+    obj.parent = empty
+
+    # Light the scene without showing up in it
+    if hasattr( obj, 'visible_camera' ):
+        obj.visible_camera = False
+    elif hasattr( obj, 'cycles_visibility' ):
+        obj.cycles_visibility.camera = False
+
+    # Many-light sampling, where this cycles version has it
+    cycles = getattr( context.scene, 'cycles', None )
+    if hasattr( cycles, 'use_light_tree' ):
+        cycles.use_light_tree = True
+
+    empty[ 'fake_hdr_emitter' ] = obj.name
+    return obj
+
+# Spherical harmonics ambient term: the HDR is projected onto the 9 real
+# SH basis functions (bands 0-2), which capture its low frequency light
+sh_level_width  = 128
+sh_band_factors = ( math.pi, ) + ( 2 * math.pi / 3, ) * 3 + ( math.pi / 4, ) * 5
+
+def sh_basis( x, y, z ):
+    """ The 9 real SH basis functions of a direction (works on floats or numpy
+    arrays) """
+    return (
+        0.282095,
+        0.488603 * y, 0.488603 * z, 0.488603 * x,
+        1.092548 * x * y, 1.092548 * y * z, 0.315392 * ( 3 * z * z - 1 ),
+        1.092548 * x * z, 0.546274 * ( x * x - y * y )
+    )
+
+def project_sh( level, exclude = () ):
+    """ Project a mip level onto SH, returning 9 ( r, g, b ) coefficients.
+    exclude holds ( direction, cos radius ) regions left out (i.e. the light
+    of the lamps that are kept). Vectorised with numpy when available """
+    width, height, pixels = level
+    d_lon = 2 * math.pi / width
+    d_lat = math.pi / height
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    if numpy:
+        px  = numpy.asarray( pixels, dtype = numpy.float64 ).reshape( height, width, 4 )[ ..., :3 ]
+        lat = ( ( numpy.arange( height ) + 0.5 ) / height - 0.5 ) * math.pi
+        lon = ( ( numpy.arange( width  ) + 0.5 ) / width  - 0.5 ) * 2 * math.pi
+        lon, lat = numpy.meshgrid( lon, lat )
+
+        # Same mapping as lon_lat_to_direction
+        x =  numpy.cos( lat ) * numpy.cos( lon )
+        y = -numpy.cos( lat ) * numpy.sin( lon )
+        z =  numpy.sin( lat )
+
+        weight = numpy.cos( lat ) * d_lon * d_lat
+        for d, cos_radius in exclude:
+            weight = weight * ( x * d[0] + y * d[1] + z * d[2] < cos_radius )
+
+        return [
+            tuple( [ float( v ) for v in ( px * ( b * weight )[ ..., None ] ).sum( axis = ( 0, 1 ) ) ] )
+            for b in sh_basis( x, y, z )
+        ]
+
+    coeffs = [ [ 0.0, 0.0, 0.0 ] for b in range( 9 ) ]
+    for row in range( height ):
+        lat     = ( ( row + 0.5 ) / height - 0.5 ) * math.pi
+        cos_lat = math.cos( lat )
+        for col in range( width ):
+            lon = ( ( col + 0.5 ) / width - 0.5 ) * 2 * math.pi
+            x, y, z = lon_lat_to_direction( lon, lat )
+
+            if [ 1 for d, c in exclude if x * d[0] + y * d[1] + z * d[2] >= c ]:
+                continue
+
+            i = ( row * width + col ) * 4
+            w = cos_lat * d_lon * d_lat
+            for coeff, b in zip( coeffs, sh_basis( x, y, z ) ):
+                coeff[0] += pixels[ i     ] * b * w
+                coeff[1] += pixels[ i + 1 ] * b * w
+                coeff[2] += pixels[ i + 2 ] * b * w
+
+    return [ tuple( c ) for c in coeffs ]
+
+def sh_radiance( coeffs, normal ):
+    """ Radiance of a uniform sky that would give the same diffuse irradiance
+    as the SH light does on a surface facing normal """
+    color = [ 0.0, 0.0, 0.0 ]
+    for coeff, b, factor in zip( coeffs, sh_basis( *normal ), sh_band_factors ):
+        for i in range( 3 ):
+            color[i] += coeff[i] * b * factor / math.pi
+
+    return [ max( c, 0.0 ) for c in color ]
+
+def set_world_ambient( context, coeffs, intensity ):
+    """ Light the world with the SH ambient: zenith and horizon colors with
+    environment lighting in blender internal, the background in cycles """
+    world = context.scene.world
+    if not world:
+        world = bpy.data.worlds.new( 'FakeHDR.World' )
+        context.scene.world = world
+
+    zenith  = sh_radiance( coeffs, ( 0, 0, 1 ) )
+    horizon = [
+        sum( c ) / 4 for c in zip( *[
+            sh_radiance( coeffs, d ) for d in ( (1,0,0), (-1,0,0), (0,1,0), (0,-1,0) )
+        ] )
+    ]
+
+    # World colors are limited to 0-1, the rest goes to the energy
+    peak = max( zenith + horizon + [ 1e-6 ] )
+
+    if context.scene.render.engine == 'CYCLES':
+        world.use_nodes = True
+        background = world.node_tree.nodes.get( 'Background' )
+        if background:
+            average = [ ( z + h ) / 2 for z, h in zip( zenith, horizon ) ]
+            background.inputs['Color'].default_value    = average + [ 1.0 ]
+            background.inputs['Strength'].default_value = intensity
+        return
+
+    world.zenith_color  = [ c / peak for c in zenith  ]
+    world.horizon_color = [ c / peak for c in horizon ]
+    world.use_sky_blend = True
+
+    light = world.light_settings
+    light.use_environment_light = True
+    light.environment_color     = 'SKY_COLOR'
+    light.environment_energy    = peak * intensity
+
+def get_sequence_files( image ):
+    """ Return ( frame number, path ) of each file of an image sequence,
+    found by the number at the end of the image's file name """
+    path         = bpy.path.abspath( image.filepath )
+    folder, name = os.path.split( path )
+    match        = re.match( r'^(.*?)(\d+)(\D*)$', name )
+    if not match or not os.path.isdir( folder ):
+        return []
+
+    prefix, digits, suffix = match.groups()
+    pattern = re.compile( '^' + re.escape( prefix ) + r'(\d+)' + re.escape( suffix ) + '$' )
+
+    files = []
+    for f in os.listdir( folder ):
+        m = pattern.match( f )
+        if m:
+            files.append( ( int( m.group(1) ), os.path.join( folder, f ) ) )
+
+    return sorted( files )
+
+def sample_frame( path, directions, n ):
+    """ Load one frame of a sequence, sample its lamps and free it again, so
+    only a single frame is ever in memory """
+    image = bpy.data.images.load( path )
+    try:
+        level = get_mip_level( image, get_refine_levels( image, n )[-1] )
+    finally:
+        mip_pyramids.pop( image.name, None )
+        bpy.data.images.remove( image )
+
+    return run_to_end( sample_lamps( level, directions, n ) )
+
+def match_tracks( tracks, candidates, directions ):
+    """ Assign this frame's brightest candidates (indices into directions) to
+    the lamps. Lamps whose candidate is still among them keep it, the others
+    take the nearest remaining candidate, so lamp identities stay stable """
+    new  = set( candidates )
+    kept = [ t if t in new else None for t in tracks ]
+    free = list( new.difference( kept ) )
+
+    for i, t in enumerate( kept ):
+        if t is None:
+            d    = directions[ tracks[i] ]
+            best = max( free, key = lambda c: sum( [ a * b for a, b in zip( directions[c], d ) ] ) )
+            free.remove( best )
+            kept[i] = best
+
+    return kept
+
+def get_fcurve( id_data, data_path, index = 0 ):
+    """ Return the fcurve animating data_path[index] of an ID, creating its
+    action and fcurve if needed """
+    if not id_data.animation_data:
+        id_data.animation_data_create()
+
+    anim = id_data.animation_data
+    if not anim.action:
+        anim.action = bpy.data.actions.new( id_data.name + 'Action' )
+
+    for fcurve in anim.action.fcurves:
+        if fcurve.data_path == data_path and fcurve.array_index == index:
+            return fcurve
+
+    return anim.action.fcurves.new( data_path, index )
+
+def set_keyframes( fcurve, frames, values ):
+    """ Replace an fcurve's keyframes, in bulk """
+    while len( fcurve.keyframe_points ):
+        fcurve.keyframe_points.remove( fcurve.keyframe_points[0], fast = True )
+
+    fcurve.keyframe_points.add( len( frames ) )
+    fcurve.keyframe_points.foreach_set(
+        'co', [ v for key in zip( frames, values ) for v in key ]
+    )
+    fcurve.update()
+
+def intensity_fcurve( lamp ):
+    """ The fcurve of a lamp's intensity, for both cycles and BI lamps (see
+    change_light_intensity) """
+    if bpy.context.scene.render.engine == 'CYCLES':
+        return get_fcurve(
+            lamp.data.node_tree, 'nodes["Emission"].inputs["Strength"].default_value'
+        )
+    return get_fcurve( lamp.data, 'energy' )
+
+# Sun detection. The peak is found on a coarse mip level, then measured on
+# the finest one by growing a region of pixels at least sun_threshold as
+# bright as the peak, up to sun_max_radius
+sun_threshold  = 0.5
+sun_max_radius = math.radians( 10.0 )
+
+# Detected suns: image name --> ( ( filepath, size ), sun )
+sun_cache = {}
+
+def find_sun( image ):
+    """ Find the brightest compact region of the HDR. Returns a dict with its
+    direction (the region's sub-pixel centroid), angle (angular diameter),
+    color and strength (luminance of its irradiance), or None """
+    stamp = ( image.filepath, tuple( image.size ) )
+    if image.name in sun_cache and sun_cache[ image.name ][0] == stamp:
+        return sun_cache[ image.name ][1]
+
+    if not image.size[0]:
+        return None
+
+    cw, ch, coarse = get_mip_level( image, min( mip_widths[1], image.size[0] ) )
+    width, height, pixels = get_mip_level( image, min( mip_widths[-1], image.size[0] ) )
+
+    def lum( col, row ):
+        i = ( row * width + col % width ) * 4
+        return luminance( pixels[ i : i + 3 ] )
+
+    # Peak on the coarse level, then the brightest fine pixel around it
+    peak   = max( range( cw * ch ), key = lambda i: luminance( coarse[ i * 4 : i * 4 + 3 ] ) )
+    scale  = width / cw
+    col0   = int( ( peak % cw + 0.5 ) * scale )
+    row0   = int( ( peak // cw + 0.5 ) * scale )
+    reach  = int( scale ) + 1
+    window = [
+        ( c, r ) for r in range( max( 0, row0 - reach ), min( height, row0 + reach + 1 ) )
+                 for c in range( col0 - reach, col0 + reach + 1 )
+    ]
+    col0, row0 = max( window, key = lambda p: lum( *p ) )
+    limit      = lum( col0, row0 ) * sun_threshold
+    max_pixels = sun_max_radius / ( math.pi / height )
+    max_cols   = max_pixels / max( math.cos( ( ( row0 + 0.5 ) / height - 0.5 ) * math.pi ), 0.1 )
+
+    # Grow the region (8-connected, wrapping around in longitude)
+    region = set( [ ( col0 % width, row0 ) ] )
+    stack  = [ ( col0 % width, row0 ) ]
+    while stack:
+        col, row = stack.pop()
+        for dc in ( -1, 0, 1 ):
+            for dr in ( -1, 0, 1 ):
+                c, r = ( col + dc ) % width, row + dr
+                if ( c, r ) in region or not 0 <= r < height:
+                    continue
+                col_dist = min( ( c - col0 ) % width, ( col0 - c ) % width )
+                if abs( r - row0 ) > max_pixels or col_dist > max_cols:
+                    continue
+                if lum( c, r ) < limit:
+                    continue
+                region.add( ( c, r ) )
+                stack.append( ( c, r ) )
+
+    # Irradiance, solid angle and luminance weighted centroid of the region
+    d_lon       = 2 * math.pi / width
+    d_lat       = math.pi / height
+    irradiance  = [ 0.0, 0.0, 0.0 ]
+    centroid    = [ 0.0, 0.0, 0.0 ]
+    solid_angle = 0.0
+    for col, row in region:
+        lon     = ( ( col + 0.5 ) / width  - 0.5 ) * 2 * math.pi
+        lat     = ( ( row + 0.5 ) / height - 0.5 ) * math.pi
+        d_omega = math.cos( lat ) * d_lon * d_lat
+        i       = ( row * width + col ) * 4
+        w       = luminance( pixels[ i : i + 3 ] ) * d_omega
+
+        direction = lon_lat_to_direction( lon, lat )
+        for k in range( 3 ):
+            irradiance[k] += pixels[ i + k ] * d_omega
+            centroid[k]   += direction[k] * w
+        solid_angle += d_omega
+
+    length = math.sqrt( sum( [ c * c for c in centroid ] ) ) or 1
+    peak   = max( irradiance ) or 1
+    sun    = {
+        'direction' : [ c / length for c in centroid ],
+        'angle'     : 2 * math.acos( max( -1.0, 1 - solid_angle / ( 2 * math.pi ) ) ),
+        'color'     : [ c / peak for c in irradiance ],
+        'strength'  : luminance( irradiance )
+    }
+
+    sun_cache[ image.name ] = ( stamp, sun )
+    return sun
+
+def set_sun_energy( lamp, value ):
+    """ Set a sun's energy to value (sun_intensity) scaled by the strength
+    detected for the rig's sun """
+    empty    = lamp.parent
+    sun      = empty.get( 'fake_hdr_sun' ) if empty else None
+    is_rig   = sun and empty.get( 'fake_hdr_sun_lamp' ) == lamp.name
+    strength = sun[ 'strength' ] if is_rig else 1.0
+    change_light_intensity( lamp, value * strength )
+
+def set_lamp_enabled( lamp, enabled ):
+    lamp.hide = lamp.hide_render = not enabled
+
+def add_sun_lamp( context, empty ):
+    """ Create the rig's sun lamp from the detected sun, and remember it and
+    the lamp standing for the same region (its twin, disabled while the sun
+    is on) on the control empty, so toggling the sun needs no lamp search """
+    sun = empty.get( 'fake_hdr_sun' )
+    if sun:
+        sun = sun.to_dict()
+    else:
+        image = bpy.data.images.get( context.scene.fake_hdr_image )
+        sun   = find_sun( image ) if image else None
+        if not sun:
+            return None
+        empty[ 'fake_hdr_sun' ] = sun
+
+    props = context.scene.fake_hdr_props
+    data  = bpy.data.lamps.new( 'FakeHDR.Sun', 'SUN' )
+    lamp  = bpy.data.objects.new( 'FakeHDR.Sun', data )
+    context.scene.objects.link( lamp )
+
+    lamp.parent      = empty
+    lamp.location    = sun['direction']
+    const            = lamp.constraints.new( type = 'DAMPED_TRACK' )
+    const.target     = empty
+    const.track_axis = 'TRACK_NEGATIVE_Z'
+
+    data.color = sun['color']
+
+    # Energy from the detected strength (set_sun_energy finds it by name)
+    empty[ 'fake_hdr_sun_lamp' ] = lamp.name
+    set_sun_energy( lamp, props.sun_intensity )
+
+    # Soft shadows matching the sun's size
+    if hasattr( data, 'angle' ):
+        data.angle = sun['angle']
+    else:
+        data.shadow_soft_size = math.tan( sun['angle'] / 2 )
+
+    # The rig's lamp nearest to the sun
+    d     = lamp.location.normalized()
+    lamps = [ c for c in empty.children if 'fake_hdr_index' in c ]
+    if lamps:
+        twin = max( lamps, key = lambda l: d.dot( l.location.normalized() ) )
+        empty[ 'fake_hdr_sun_twin' ] = twin.name
+        set_lamp_enabled( twin, False )
+
+    # Or, in an emitter rig, the emitter face nearest to the sun
+    emitter = context.scene.objects.get( empty.get( 'fake_hdr_emitter', '' ) )
+    if emitter:
+        find_sun_face( empty, emitter )
+        set_sun_face_enabled( empty, emitter, False )
+
+    return lamp
+
+# Incremented each time a rig is built, so a progressive refinement that was
+# superseded (i.e. num_of_lamps was changed again) stops itself
+refine_generation = 0
         
 class fake_hdr(bpy.types.Panel):
     bl_idname      = "FakeHDR"
@@ -117,8 +1122,16 @@ class fake_hdr(bpy.types.Panel):
 
         col.prop( props, 'num_of_lamps' )
         col.prop( props, 'shadow_casting_lamps' )
+        col.prop( props, 'placement_method' )
+        col.prop( props, 'output_mode' )
+        if props.output_mode == 'CYCLES_MESH':
+            col.prop( props, 'emitter_distance' )
+        if props.placement_method == 'MIP_SAMPLE':
+            col.prop( props, 'live_preview' )
+        col.prop( props, 'use_cache' )
 
         layout.operator( 'render.create_hdr_sphere', icon = 'MAT_SPHERE_SKY' )
+        layout.operator( 'render.create_hdr_sequence_rig', icon = 'SEQUENCE' )
 
         if 'FakeHDR.LightArray.Control' in context.scene.objects:
             lbl = layout.label( "Update lamp properties" )
@@ -183,7 +1196,22 @@ class fake_hdr(bpy.types.Panel):
                 )
             
             layout.separator()
-            lbl = layout.label( "Make sun lamp of strongest light" )
+            lbl = layout.label( "Optimize lamps" )
+            box = layout.box()
+            col = box.column()
+
+            row = col.row()
+            row.prop( context.scene.fake_hdr_props, 'cull_threshold' )
+            row.prop( context.scene.fake_hdr_props, 'merge_angle' )
+            col.operator( 'render.optimize_hdr_lamps', icon = 'LAMP_POINT' )
+
+            row = col.row()
+            row.prop( context.scene.fake_hdr_props, 'ambient_lamps' )
+            row.prop( context.scene.fake_hdr_props, 'ambient_intensity' )
+            col.operator( 'render.hdr_ambient', icon = 'WORLD' )
+
+            layout.separator()
+            lbl = layout.label( "Make sun lamp of the HDR's sun" )
             box = layout.box()
             col = box.column()
             
@@ -313,23 +1341,48 @@ class create_hdr_sphere( bpy.types.Operator ):
         vcolors = { v : avg_vcolors[v] for v in culled_vert_list }
         
         return vcolors
+
+    def get_lamp_data( self, context, obj, n ):
+        """ Return ( location, color, intensity ) of each lamp, from the
+        darkest to the brightest """
+        verts   = obj.data.vertices
+        vcolors = self.get_vcolors( context, obj, n )
+        ordered = sort_by_value( vcolors, [], 1 )
+
+        return [
+            ( tuple( verts[v].co ), ) + normalize_color( tuple( vcolors[v] ) )
+            for v in ordered
+        ]
         
-    def create_lamps( self, context, obj ):
+    def create_lamps( self, context, lamp_data, obj = None, output_mode = None, use_sun = None ):
         # Create empty which will act as the lamps' parent object
         bpy.ops.object.empty_add( type = 'SPHERE' )
 
         empty      = context.scene.objects[ context.object.name ]
         empty.name = 'FakeHDR.LightArray.Control' 
 
-        # Set empty as the sphere's parent
-        obj.parent = empty
+        # Set empty as the sphere's parent (there's no sphere when the lamps
+        # were read from the cache)
+        if obj:
+            obj.parent = empty
+
+        # Solid angle of the region of the HDR each lamp stands for
+        region = 4 * math.pi / candidate_count( len( lamp_data ) )
+        empty[ 'fake_hdr_solid_angle' ] = region
+
+        props = context.scene.fake_hdr_props
+        if use_sun is None:
+            use_sun = props.use_sun
+
+        if ( output_mode or props.output_mode ) == 'CYCLES_MESH':
+            create_emitters( context, empty, lamp_data )
+            if use_sun:
+                add_sun_lamp( context, empty )
+            return []
 
-        n       = context.scene.fake_hdr_props.num_of_lamps
         lamps   = []
-        verts   = obj.data.vertices
-        vcolors = self.get_vcolors( context, obj, n )
         
-        for i,v in enumerate( vcolors.keys() ):
+        for i, ( location, color, intensity ) in enumerate( lamp_data ):
             bpy.ops.object.lamp_add( type = 'POINT' )
 
             # Reference lamp (which is now the selected and active object
@@ -337,6 +1390,10 @@ class create_hdr_sphere( bpy.types.Operator ):
             lamp.name = 'fake_hdr_lamp'
             lamps.append( lamp.name )
 
+            # Brightness order, used to update the lamps when refining
+            lamp[ 'fake_hdr_index' ]       = i
+            lamp[ 'fake_hdr_solid_angle' ] = region
+
             # Parent lamp to empty, and:
             # Create damped track constraint from lamp to empty to make sure
             # spots and sun always look in the direction of the empty
@@ -346,37 +1403,390 @@ class create_hdr_sphere( bpy.types.Operator ):
             const.track_axis = 'TRACK_NEGATIVE_Z'
 
             # Set lamp location
-            lamp.location = verts[v].co
+            lamp.location = location
             
-            # Set lamp color
-            lamp.data.color = vcolors[v]
+            # Set lamp color, and energy from the HDR's intensity (colors are
+            # normalized to a peak of 1, see normalize_color)
+            props = context.scene.fake_hdr_props
+            lamp.data.color = color
+            lamp[ 'fake_hdr_intensity' ] = intensity
+            set_lamp_energy( lamp, props.lamp_intensity )
             
             # Set all default parameters
-            props = context.scene.fake_hdr_props
             lamp.data.distance           = props.lamp_distance
             lamp.data.shadow_ray_samples = props.lamp_ray_samples
             lamp.data.shadow_soft_size   = props.lamp_size
             lamp.data.use_specular       = props.lamp_use_specular
             
-            # make the strongest lamp a sun if option is turned on
-            if context.scene.fake_hdr_props.use_sun and i == len( vcolors ) - 1:
-                lamp.data.type = 'SUN'
-                value = context.scene.fake_hdr_props.sun_intensity
-                change_light_intensity( lamp, value )
+        # Add a sun lamp at the HDR's sun if option is turned on
+        if use_sun:
+            add_sun_lamp( context, empty )
 
         return lamps
 
+    def load_cached( self, context, image, n ):
+        """ Create the rig from the cache. Returns False if it isn't cached """
+        props = context.scene.fake_hdr_props
+        if not props.use_cache:
+            return False
+
+        lamp_data = load_cached_lamps( image, n, props.placement_method )
+        if lamp_data is None:
+            return False
+
+        self.report( {'INFO'}, "Using cached lamps for " + image.name )
+        self.create_lamps( context, lamp_data )
+        return True
+
+    def store( self, context, image, n, lamp_data ):
+        props = context.scene.fake_hdr_props
+        if props.use_cache:
+            store_cached_lamps( image, n, props.placement_method, lamp_data )
+
     def execute( self, context ):
-        n   = context.scene.fake_hdr_props.num_of_lamps
-        obj = self.create_sphere( context, n )
-        self.map_hdr_to_sphere( context, obj )
-        self.bake_textures_to_verts( context, obj )
-        lamps = self.create_lamps( context, obj )
+        global refine_generation
+
+        props = context.scene.fake_hdr_props
+        n     = props.num_of_lamps
+        image = bpy.data.images[ context.scene.fake_hdr_image ]
+
+        # Any refinement still running belongs to an older rig
+        refine_generation += 1
+
+        # Skip the whole analysis if this image was analysed before
+        if self.load_cached( context, image, n ):
+            return {'FINISHED'}
+
+        obj = None
+        if props.placement_method == 'MIP_SAMPLE':
+            # Not run from the UI: no preview, sample the finest level directly
+            directions = fibonacci_directions( candidate_count( n ) )
+            level      = get_mip_level( image, get_refine_levels( image, n )[-1] )
+            lamp_data  = run_to_end( sample_lamps( level, directions, n ) )
+        else:
+            obj = self.create_sphere( context, n )
+            self.map_hdr_to_sphere( context, obj )
+            self.bake_textures_to_verts( context, obj )
+            lamp_data = self.get_lamp_data( context, obj, n )
+
+        self.store( context, image, n, lamp_data )
+        lamps = self.create_lamps( context, lamp_data, obj )
         
         return {'FINISHED'}
 
+    def invoke( self, context, event ):
+        """ In sampling mode, create a preview rig from a low mip level right
+        away, then refine it level by level on timer events """
+        global refine_generation
+
+        props = context.scene.fake_hdr_props
+        n     = props.num_of_lamps
+        image = bpy.data.images[ context.scene.fake_hdr_image ]
+
+        if props.placement_method != 'MIP_SAMPLE':
+            return self.execute( context )
+
+        # Any refinement still running belongs to an older rig
+        refine_generation += 1
+        self.generation     = refine_generation
+
+        if self.load_cached( context, image, n ):
+            return {'FINISHED'}
+
+        if not image.size[0]:
+            self.report( {'ERROR'}, "Can't read image " + image.name )
+            return {'CANCELLED'}
+
+        self.image_name = image.name
+        self.n          = n
+        self.directions = fibonacci_directions( candidate_count( n ) )
+        self.levels     = get_refine_levels( image, n )
+        self.job        = None
+
+        lamp_data = run_to_end( sample_lamps(
+            get_mip_level( image, self.levels.pop( 0 ) ), self.directions, n
+        ) )
+        self.create_lamps( context, lamp_data )
+
+        if not self.levels:
+            self.store( context, image, n, lamp_data )
+            return {'FINISHED'}
+
+        wm         = context.window_manager
+        self.timer = wm.event_timer_add( 0.05, context.window )
+        wm.modal_handler_add( self )
+
+        return {'RUNNING_MODAL'}
+
+    def modal( self, context, event ):
+        # Stop if superseded by a new rig, or the rig was deleted
+        stale = self.generation != refine_generation
+        if stale or event.type == 'ESC' or \
+           'FakeHDR.LightArray.Control' not in context.scene.objects:
+            context.window_manager.event_timer_remove( self.timer )
+            return {'CANCELLED'}
+
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        image = bpy.data.images[ self.image_name ]
+        if self.job is None:
+            level    = get_mip_level( image, self.levels.pop( 0 ) )
+            self.job = sample_lamps( level, self.directions, self.n )
+
+        lamp_data = next( self.job )
+        if lamp_data is None:
+            return {'PASS_THROUGH'}
+
+        apply_lamp_data( context, lamp_data )
+        self.job = None
+
+        if not self.levels:
+            # Only fully refined results are cached
+            self.store( context, image, self.n, lamp_data )
+            context.window_manager.event_timer_remove( self.timer )
+            return {'FINISHED'}
+
+        return {'PASS_THROUGH'}
+
+class create_hdr_sequence_rig( create_hdr_sphere ):
+    """ Create one animated light array from an HDR image sequence """
+    bl_idname      = "render.create_hdr_sequence_rig"
+    bl_label       = "Create animated light array"
+    bl_description = ( "Create a light array following an HDR image sequence, "
+                       "with keyframed lamp positions, colors and intensities" )
+    bl_options     = {'REGISTER', 'UNDO' }
+
+    @classmethod
+    def poll( self, context ):
+        name = context.scene.fake_hdr_image
+        return name in bpy.data.images and bpy.data.images[ name ].source == 'SEQUENCE'
+
+    def invoke( self, context, event ):
+        return self.execute( context )
+
+    def execute( self, context ):
+        global refine_generation
+
+        props = context.scene.fake_hdr_props
+        n     = props.num_of_lamps
+        image = bpy.data.images[ context.scene.fake_hdr_image ]
+        files = get_sequence_files( image )
+
+        # Any refinement still running belongs to an older rig
+        refine_generation += 1
+
+        if not files:
+            self.report( {'ERROR'}, "No frames found for " + image.filepath )
+            return {'CANCELLED'}
+
+        directions = fibonacci_directions( candidate_count( n ) )
+        index_of   = dict( [ ( d, i ) for i, d in enumerate( directions ) ] )
+
+        # The first frame creates the rig, its lamps are tracked from there.
+        # The sun lamp is static, so the sun stays part of the animated lamps
+        lamp_data = sample_frame( files[0][1], directions, n )
+        lamps     = [
+            context.scene.objects[ name ] for name in self.create_lamps(
+                context, lamp_data, output_mode = 'LAMPS', use_sun = False
+            )
+        ]
+        empty = context.scene.objects[ 'FakeHDR.LightArray.Control' ]
+        empty[ 'fake_hdr_sequence' ] = True
+        tracks    = [ index_of[ d ] for d, color, intensity in lamp_data ]
+
+        # Per lamp lists of keyframe values, written in bulk at the end
+        frames = []
+        keys   = [ [ [] for c in range( 7 ) ] for l in lamps ]
+
+        wm = context.window_manager
+        wm.progress_begin( 0, len( files ) )
+        for f, ( number, path ) in enumerate( files ):
+            if f:
+                lamp_data = sample_frame( path, directions, n )
+                tracks    = match_tracks(
+                    tracks, [ index_of[ d ] for d, c, i in lamp_data ], directions
+                )
+
+            samples = dict( [ ( index_of[ d ], ( c, i ) ) for d, c, i in lamp_data ] )
+            frames.append( context.scene.frame_start + number - files[0][0] )
+
+            for lamp_keys, t in zip( keys, tracks ):
+                color, intensity = samples[ t ]
+                values = list( directions[ t ] ) + list( color ) + [ intensity ]
+                for channel, v in zip( lamp_keys, values ):
+                    channel.append( v )
+
+            wm.progress_update( f )
+        wm.progress_end()
+
+        # Key the energy set_lamp_energy would set for each frame's intensity,
+        # so every frame looks like a static rig of that frame's image
+        for lamp, lamp_keys in zip( lamps, keys ):
+            if context.scene.render.engine == 'CYCLES':
+                lamp.data.use_nodes = True
+
+            base = props.lamp_intensity * lamp_weight( lamp )
+            for i in range( 3 ):
+                set_keyframes( get_fcurve( lamp, 'location', i ), frames, lamp_keys[i] )
+                set_keyframes( get_fcurve( lamp.data, 'color', i ), frames, lamp_keys[ 3 + i ] )
+            set_keyframes(
+                intensity_fcurve( lamp ), frames, [ v * base for v in lamp_keys[6] ]
+            )
+
+        if props.use_sun:
+            self.report(
+                {'WARNING'},
+                "Animated %d lamps over %d frames, without a separate sun "
+                "(it would stay at the first frame's sun)" % ( len( lamps ), len( frames ) )
+            )
+        else:
+            self.report( {'INFO'}, "Animated %d lamps over %d frames" % ( len( lamps ), len( frames ) ) )
+        return {'FINISHED'}
+
+class optimize_hdr_lamps( bpy.types.Operator ):
+    """ Cull and merge the rig's lamps by their contribution to the scene """
+    bl_idname      = "render.optimize_hdr_lamps"
+    bl_label       = "Optimize lamps"
+    bl_description = ( "Remove lamps contributing little light, merge lamps close "
+                       "to each other and give shadows to the strongest lamps" )
+    bl_options     = {'REGISTER', 'UNDO' }
+
+    @classmethod
+    def poll( self, context ):
+        return 'FakeHDR.LightArray.Control' in context.scene.objects
+
+    def execute( self, context ):
+        props = context.scene.fake_hdr_props
+        lamps = props.find_lamps( context, enabled_only = True )
+        if not lamps:
+            return {'CANCELLED'}
+
+        before = rig_stats( lamps )
+
+        # The sun is never culled or merged
+        suns  = [ l for l in lamps if l.data.type == 'SUN' ]
+        lamps = [ l for l in lamps if l.data.type != 'SUN' ]
+
+        # Merge near-duplicates into the strongest lamp among them
+        lamps.sort( key = lamp_contribution, reverse = True )
+        min_cos = math.cos( props.merge_angle )
+        merged  = set()
+        removed = []
+        for i, keep in enumerate( lamps ):
+            if keep.name in merged:
+                continue
+
+            d     = keep.location.normalized()
+            close = [
+                l for l in lamps[ i + 1: ] if l.name not in merged and
+                d.dot( l.location.normalized() ) >= min_cos
+            ]
+            if close:
+                merge_lamps( keep, close )
+                merged.update( [ l.name for l in close ] )
+                removed.extend( close )
+
+        lamps = [ l for l in lamps if l.name not in merged ]
+
+        # Cull lamps contributing less than the threshold (relative to the
+        # strongest lamp)
+        if lamps:
+            threshold = props.cull_threshold * max( [ lamp_contribution( l ) for l in lamps ] )
+            culled    = [ l for l in lamps if lamp_contribution( l ) < threshold ]
+            removed.extend( culled )
+            lamps     = [ l for l in lamps if lamp_contribution( l ) >= threshold ]
+
+        remove_objects( context.scene, removed )
+
+        # Renumber from the weakest to the strongest, and spend the shadow
+        # budget on the strongest lamps
+        lamps = sorted( lamps, key = lamp_contribution )
+        index_lamps( lamps, suns )
+        lamps = lamps + suns
+        props.update_shadow_type( context )
+
+        after  = rig_stats( lamps )
+        report = (
+            "Lamps %d -> %d, shadow casters %d -> %d, "
+            "estimated cost %d -> %d, light kept %.1f%%" % (
+                before[0], after[0], before[1], after[1], before[2], after[2],
+                100 * after[3] / ( before[3] or 1 )
+            )
+        )
+        self.report( {'INFO'}, report )
+
+        return {'FINISHED'}
+
+class hdr_ambient( bpy.types.Operator ):
+    """ Replace the dim lamps with an ambient term from the HDR's SH """
+    bl_idname      = "render.hdr_ambient"
+    bl_label       = "Replace dim lamps with ambient"
+    bl_description = ( "Keep only the brightest lamps, and light the world with "
+                       "the rest of the HDR's (low frequency) light" )
+    bl_options     = {'REGISTER', 'UNDO' }
+
+    @classmethod
+    def poll( self, context ):
+        objs = context.scene.objects
+        if not context.scene.fake_hdr_image or 'FakeHDR.LightArray.Control' not in objs:
+            return False
+
+        # Emitter rigs already cover the whole HDR, the ambient would add
+        # the same light again
+        return 'fake_hdr_emitter' not in objs[ 'FakeHDR.LightArray.Control' ]
+
+    def execute( self, context ):
+        props = context.scene.fake_hdr_props
+        image = bpy.data.images[ context.scene.fake_hdr_image ]
+        empty = context.scene.objects[ 'FakeHDR.LightArray.Control' ]
+
+        # Keep the top K lamps (and the sun), remove the rest. The sun's
+        # disabled twin is left alone, the sun stands for its region
+        lamps   = props.find_lamps( context, enabled_only = True )
+        others  = [ l for l in lamps if l.data.type != 'SUN' ]
+        keep    = others[ -props.ambient_lamps: ] if props.ambient_lamps else []
+        removed = [ l for l in others if l not in keep ]
+        suns    = [ l for l in lamps if l.data.type == 'SUN' ]
+        index_lamps( keep, suns )
+        keep    = keep + suns
+
+        # The ambient covers the HDR except for the regions of the kept lamps
+        exclude = []
+        for l in keep:
+            solid_angle = l.get( 'fake_hdr_solid_angle', empty.get( 'fake_hdr_solid_angle', 0 ) )
+            exclude.append(
+                ( tuple( l.location.normalized() ), 1 - solid_angle / ( 2 * math.pi ) )
+            )
+
+        level  = get_mip_level( image, min( sh_level_width, image.size[0] ) )
+        coeffs = project_sh( level, exclude )
+
+        set_world_ambient( context, coeffs, props.ambient_intensity )
+        empty[ 'fake_hdr_sh' ] = [ c for coeff in coeffs for c in coeff ]
+
+        remove_objects( context.scene, removed )
+        props.update_shadow_type( context )
+
+        self.report(
+            {'INFO'}, "Kept %d of %d lamps, the rest is ambient light" % ( len( keep ), len( lamps ) )
+        )
+        return {'FINISHED'}
+
 class fake_HDR_props( bpy.types.PropertyGroup ):
-    def find_lamps( self, context ):
+    def update_num_of_lamps( self, context ):
+        # Rebuild the preview rig while scrubbing the number of lamps
+        if not ( self.live_preview and self.placement_method == 'MIP_SAMPLE' ):
+            return
+        if 'FakeHDR.LightArray.Control' not in context.scene.objects:
+            return
+
+        remove_rig( context )
+        bpy.ops.render.create_hdr_sphere( 'INVOKE_DEFAULT' )
+
+    def find_lamps( self, context, enabled_only = False ):
+        """ The rig's lamps. enabled_only leaves out disabled lamps (the sun's
+        twin while the sun is on), for picking lamps by their light """
         empty = context.scene.objects['FakeHDR.LightArray.Control']
         objs  = context.scene.objects
 
@@ -384,24 +1794,25 @@ class fake_HDR_props( bpy.types.PropertyGroup ):
         all_lamps = [ 
             objs[c.name] for c in empty.children if c.type == 'LAMP'
         ]
+        if enabled_only:
+            all_lamps = [ l for l in all_lamps if not l.hide_render ]
 
-        lamp_indices_and_colors = { 
-            i : all_lamps[i].data.color for i in range( len( all_lamps ) )
-        }
-
-        # Sort and return list of lamps sorted by color value (brightness)
-        sorted_indices = sort_by_value( lamp_indices_and_colors, [], 1 )
-
-        return [ all_lamps[i] for i in sorted_indices ]
+        # Return list of lamps sorted by their contribution (so lamps merged
+        # from several regions rank by all the light they stand for)
+        return sorted( all_lamps, key = lamp_contribution )
 
     def update_intensity( self, context ):
         value  = context.scene.fake_hdr_props.lamp_intensity
         svalue = context.scene.fake_hdr_props.sun_intensity
         for l in self.find_lamps(context):
             if l.data.type != 'SUN':
-                change_light_intensity( l, value )
+                set_lamp_energy( l, value )
             else:
-                change_light_intensity( l, svalue )
+                set_sun_energy( l, svalue )
+
+        # Emitters share a single strength in their material
+        if emitter_material in bpy.data.materials:
+            get_emitter_material( value )
 
     def update_size( self, context ):
         for l in self.find_lamps(context):
@@ -428,7 +1839,12 @@ class fake_HDR_props( bpy.types.PropertyGroup ):
         if t == 'SPOT':
             stype = context.scene.fake_hdr_props.spot_shadow_type
 
-        lamps = self.find_lamps( context )
+        lamps = self.find_lamps( context, enabled_only = True )
+
+        # Disabled lamps don't use up the shadow budget
+        for l in self.find_lamps( context ):
+            if l.hide_render:
+                l.data.shadow_method = 'NOSHADOW'
 
         # Make sure only the number of lamps indicated by user will cast shadows
         for i,l in enumerate( lamps ):
@@ -443,35 +1859,33 @@ class fake_HDR_props( bpy.types.PropertyGroup ):
             l.data.shadow_ray_samples = value
 
     def update_use_sun( self, context ):
-        lamps      = self.find_lamps(context)
-        sun_exists = 'SUN' in [ l.data.type for l in lamps ]
-        use_sun    = context.scene.fake_hdr_props.use_sun
-
-        if not use_sun:
-            if sun_exists:
-                default_type = context.scene.fake_hdr_props.lamp_type
-                default_int  = context.scene.fake_hdr_props.lamp_intensity
-
-                for l in lamps:
-                    if l.data.type == 'SUN':
-                        l.data.type = default_type
-                        change_light_intensity( l, default_int )
-
-        else:
-            intensities = {          # Summarize rgb to get intensity
-                l : sum( [ c for c in l.data.color ] ) for l in lamps
-            }
-        
-            max_lightint = max( intensities.values() ) # Find highest intensity
-
-            for l,i in intensities.items():
-                if i == max_lightint:
-                    l.data.type = 'SUN'
-
-                    value = context.scene.fake_hdr_props.sun_intensity
-                    change_light_intensity( l, value )
-
-                    break # Make sure than no more than one sun exists
+        objs    = context.scene.objects
+        empty   = objs.get( 'FakeHDR.LightArray.Control' )
+        use_sun = context.scene.fake_hdr_props.use_sun
+        if not empty:
+            return
+
+        # The sun and its twin are looked up by name, no need to scan lamps
+        # Sequence rigs have no sun lamp, the sun is one of the animated lamps
+        if empty.get( 'fake_hdr_sequence' ):
+            return
+
+        sun = objs.get( empty.get( 'fake_hdr_sun_lamp', '' ) )
+        if use_sun and not sun:
+            sun = add_sun_lamp( context, empty )
+
+        if sun:
+            set_lamp_enabled( sun, use_sun )
+
+        twin = objs.get( empty.get( 'fake_hdr_sun_twin', '' ) )
+        if twin:
+            set_lamp_enabled( twin, not use_sun )
+            # The shadows go to the lamps that are on
+            self.update_shadow_type( context )
+
+        emitter = objs.get( empty.get( 'fake_hdr_emitter', '' ) )
+        if emitter:
+            set_sun_face_enabled( empty, emitter, not use_sun )
 
     def update_spot_size( self, context ):
         value = context.scene.fake_hdr_props.spot_size
@@ -524,7 +1938,8 @@ class fake_HDR_props( bpy.types.PropertyGroup ):
         name        = "Number of Lamps",
         default     = 50,
         min         = 12,
-        max         = 2500
+        max         = 2500,
+        update      = update_num_of_lamps
     )
 
     shadow_casting_lamps = bpy.props.IntProperty(
@@ -534,6 +1949,82 @@ class fake_HDR_props( bpy.types.PropertyGroup ):
         min         = 0,
         max         = 2500
     )
+
+    cull_threshold = bpy.props.FloatProperty(
+        name        = "Cull below",
+        description = "Remove lamps contributing less than this fraction of the strongest lamp",
+        default     = 0.02,
+        min         = 0.0,
+        max         = 1.0,
+        subtype     = 'FACTOR'
+    )
+
+    merge_angle = bpy.props.FloatProperty(
+        name        = "Merge angle",
+        description = "Merge lamps closer to each other than this angle",
+        default     = math.radians( 5.0 ),
+        min         = 0.0,
+        max         = math.radians( 90.0 ),
+        subtype     = 'ANGLE'
+    )
+
+    ambient_lamps = bpy.props.IntProperty(
+        name        = "Keep lamps",
+        description = "Number of brightest lamps kept when replacing the rest with ambient light",
+        default     = 8,
+        min         = 0,
+        max         = 2500
+    )
+
+    ambient_intensity = bpy.props.FloatProperty(
+        name        = "Ambient",
+        description = "Multiplier of the ambient light's energy",
+        default     = 1.0,
+        min         = 0.0
+    )
+
+    output_modes = [
+        ( 'LAMPS',       'Lamps',   'An array of point or spot lamps' ),
+        ( 'CYCLES_MESH', 'Emitters', 'One cycles mesh light with an emitter per region, sharing one material' )
+    ]
+
+    output_mode = bpy.props.EnumProperty(
+        name        = "Output",
+        description = "What the light array is made of",
+        items       = output_modes,
+        default     = 'LAMPS'
+    )
+
+    emitter_distance = bpy.props.FloatProperty(
+        name        = "Emitter distance",
+        description = "Distance of the emitters from the center of the rig",
+        default     = 50.0,
+        min         = 0.01
+    )
+
+    placement_methods = [
+        ( 'ICOSPHERE_BAKE', 'Bake',   'Bake the image to an icosphere\'s vertex colors (Blender Internal only)' ),
+        ( 'MIP_SAMPLE',     'Sample', 'Sample the image directly, with a quick preview refined progressively' )
+    ]
+
+    placement_method = bpy.props.EnumProperty(
+        name        = "Placement",
+        description = "How lamp positions and colors are found",
+        items       = placement_methods,
+        default     = 'ICOSPHERE_BAKE'
+    )
+
+    live_preview = bpy.props.BoolProperty(
+        name        = "Live preview",
+        description = "Rebuild the rig while changing the number of lamps",
+        default     = False
+    )
+
+    use_cache = bpy.props.BoolProperty(
+        name        = "Use cache",
+        description = "Reuse lamps computed before for this image and number of lamps",
+        default     = True
+    )
     
     types = [('POINT', 'point', ''), ('SPOT', 'spot', '')]
     lamp_type = bpy.props.EnumProperty(
@@ -593,7 +2084,7 @@ class fake_HDR_props( bpy.types.PropertyGroup ):
 
     use_sun = bpy.props.BoolProperty(
         name        = "Create sun",
-        description = "Make strongest light a sun lamp",
+        description = "Add a sun lamp at the HDR's sun (its brightest compact region)",
         default     = True,
         update      = update_use_sun
     )
@@ -31,73 +31,384 @@
 bl_info = {    
     "name"       : "Hierarchy editor",
     "author"     : "Tamir Lousky",
-    "version"    : (0, 0, 1),
+    "version"    : (0, 1, 0),
     "blender"    : (2, 67, 0),
     "category"   : "Object",
-    "location"   : "3D View >> Header",
+    "location"   : "Node Editor >> Hierarchy Tree >> Tools",
     "wiki_url"   : "",
     "tracker_url": "",
     "description": "Hypergraph-like parenting editor"
 }
 
-﻿import bpy
-# XXX these don't work yet ...
-#from bpy_types import NodeTree, Node, NodeSocket
+import bpy
+from bpy.app.handlers import persistent
+from mathutils         import Matrix
+
+# Spacing between nodes in the generated hierarchy tree
+node_spacing_x = 250
+node_spacing_y = 40
+
+# Last known parent of each object shown in a hierarchy tree, keyed by tree
+# name and then by object name. Used to find what changed on each update
+known_parents   = {}
+
+# Parent changes made in the node editor that weren't applied to the scene
+# yet: { object name : parent name (or None) }
+pending_parents = {}
+
+# Set while the tree and the scene are being synced, to avoid feedback loops
+syncing = False
+
+def build_parent_index( objects ):
+    """ Build a parent --> children index of all objects in a single pass.
+    Returns the index (keyed by parent name) and a list of root objects.
+    Objects parented to objects outside of the given collection are treated
+    as roots """
+    objects  = list( objects )
+    names    = set( o.name for o in objects )
+    children = {}
+    roots    = []
+
+    for obj in objects:
+        if obj.parent and obj.parent.name in names:
+            children.setdefault( obj.parent.name, [] ).append( obj.name )
+        else:
+            roots.append( obj.name )
+
+    return children, roots
+
+def map_objects( objects ):
+    """ Name --> object dict. Looking objects up by name in bpy.data.objects
+    is a linear search, so map them once for code doing many lookups """
+    return { o.name : o for o in objects }
+
+def get_depth( obj ):
+    """ Number of parents above an object """
+    depth = 0
+    while obj.parent:
+        obj    = obj.parent
+        depth += 1
+    return depth
+
+def add_object_node( tree, obj, location ):
+    """ Create a (collapsed) node representing an object, with its parent
+    and children sockets (see MyCustomNode.init) """
+    node = tree.nodes.new( 'CustomNodeType' )
+
+    node.name        = obj.name
+    node.object_name = obj.name
+    node.location    = location
+    node.hide        = True
+
+    return node
+
+def ensure_socket( node, is_output ):
+    """ Return the node's parent (input) or children (output) socket,
+    creating it if the node doesn't have one yet """
+    if is_output:
+        sockets, name = node.outputs, "Children"
+    else:
+        sockets, name = node.inputs,  "Parent"
+
+    if not sockets:
+        sockets.new( 'CustomSocketType', name )
+
+    return sockets[0]
+
+def link_nodes( tree, parent_node, child_node ):
+    tree.links.new(
+        ensure_socket( parent_node, True ), ensure_socket( child_node, False )
+    )
+
+def build_hierarchy_tree( tree, objects ):
+    """ Replace the tree's content with a node per object, linked according
+    to the object parenting. Nodes are laid out like the outliner: one row
+    per object, indented by parenting depth """
+    global syncing
+
+    objects         = map_objects( objects )
+    children, roots = build_parent_index( objects.values() )
+
+    syncing = True
+    try:
+        tree.nodes.clear()
+        links = tree.links
+
+        # Keep our own name --> node reference, since looking nodes up by name
+        # in the tree is a linear search
+        nodes   = {}
+        parents = {}
+        row     = 0
+        stack   = [ ( name, 0, None ) for name in reversed( roots ) ]
+
+        while stack:
+            name, depth, parent = stack.pop()
+
+            nodes[name] = add_object_node(
+                tree,
+                objects[ name ],
+                ( depth * node_spacing_x, -row * node_spacing_y )
+            )
+            parents[name] = parent
+
+            if parent:
+                link_nodes( tree, nodes[parent], nodes[name] )
+
+            row += 1
+            stack.extend( [
+                ( c, depth + 1, name ) for c in reversed( children.get( name, [] ) )
+            ] )
+
+        known_parents[ tree.name ] = parents
+    finally:
+        syncing = False
+
+    return nodes
+
+def get_linked_parents( tree ):
+    """ Read the parenting represented by the tree's links """
+    parents = {
+        n.object_name : None for n in tree.nodes if getattr( n, 'object_name', '' )
+    }
+    for link in tree.links:
+        child  = getattr( link.to_node,   'object_name', '' )
+        parent = getattr( link.from_node, 'object_name', '' )
+        if child and parent and link.to_socket.name == 'Parent':
+            parents[ child ] = parent
+
+    return parents
+
+def get_known_parents( tree ):
+    """ Return the last known parenting of a tree (read from its links the
+    first time the tree is seen, i.e. after loading a file) """
+    if tree.name not in known_parents:
+        known_parents[ tree.name ] = get_linked_parents( tree )
+    return known_parents[ tree.name ]
+
+def queue_tree_changes( tree ):
+    """ Diff the tree's links against its last known state and queue the
+    parent changes of the objects whose links changed """
+    known = get_known_parents( tree )
+
+    for name, parent in get_linked_parents( tree ).items():
+        if name in known and known[name] != parent:
+            known[name]           = parent
+            pending_parents[name] = parent
+
+    if pending_parents and hasattr( bpy.app, 'timers' ):
+        if not bpy.app.timers.is_registered( apply_pending_parents ):
+            bpy.app.timers.register( apply_pending_parents )
+
+def set_parents_keep_transform( changes ):
+    """ Re-parent objects while preserving their world transforms.
+    World matrices are captured before changing anything, so that objects
+    parented to other objects in the same batch are handled correctly.
+    Objects can't keep their transform under a parent scaled to zero, those
+    are left as they are. Returns their names """
+    objs     = map_objects( bpy.data.objects )
+    names    = set( changes ) | set( p for p in changes.values() if p )
+    worlds   = { n : objs[n].matrix_world.copy() for n in names if n in objs }
+    skipped  = []
+    inverses = {}
+
+    for name, parent_name in changes.items():
+        if name not in objs or ( parent_name and parent_name not in objs ):
+            continue
+
+        obj = objs[ name ]
+        if parent_name:
+            if parent_name not in inverses:
+                try:
+                    inverses[ parent_name ] = worlds[ parent_name ].inverted()
+                except ValueError:
+                    inverses[ parent_name ] = None  # Singular matrix
+
+            if inverses[ parent_name ] is None:
+                skipped.append( name )
+                continue
+
+            obj.parent                = objs[ parent_name ]
+            obj.matrix_parent_inverse = inverses[ parent_name ]
+        else:
+            obj.parent = None
+            obj.matrix_parent_inverse = Matrix.Identity( 4 )
+
+        obj.matrix_basis = worlds[ name ]
+
+    return skipped
+
+def apply_pending_parents():
+    """ Apply all queued parent changes in one batch """
+    global syncing
+
+    if pending_parents:
+        syncing = True
+        try:
+            skipped = set_parents_keep_transform( pending_parents )
+        finally:
+            pending_parents.clear()
+            syncing = False
+
+        if skipped:
+            print( "Hierarchy editor: can't parent to zero scale objects:", ", ".join( skipped ) )
+            # Put the skipped objects' links back where their parents are
+            objs = map_objects( bpy.data.objects )
+            sync_objects_to_trees( [ objs[ n ] for n in skipped ] )
+
+def relink_object_node( tree, obj, parent_name, nodes ):
+    """ Update a single node's parent link to match its object.
+    nodes is a name --> node dict of the tree's nodes """
+    links = tree.links
+
+    if obj.name in nodes:
+        node = nodes[ obj.name ]
+        if node.inputs:
+            for link in node.inputs[0].links:
+                links.remove( link )
+    else:
+        # A new object: place its node below its parent's node
+        location = ( 0, 0 )
+        if parent_name in nodes:
+            parent_loc = nodes[ parent_name ].location
+            location   = ( parent_loc.x + node_spacing_x, parent_loc.y - node_spacing_y )
+        node = add_object_node( tree, obj, location )
+        nodes[ obj.name ] = node
+
+    if parent_name in nodes:
+        link_nodes( tree, nodes[ parent_name ], node )
+
+def sync_objects_to_trees( objects ):
+    """ Update the hierarchy trees for the given (changed) objects only """
+    global syncing
+
+    trees = [
+        t for t in bpy.data.node_groups if t.bl_idname == 'CustomTreeType'
+    ]
 
-# Implementation of custom nodes from Python
+    syncing = True
+    try:
+        for tree in trees:
+            known = get_known_parents( tree )
+            nodes = None
+            for obj in objects:
+                parent_name = obj.parent.name if obj.parent else None
+                if obj.name not in known or known[ obj.name ] != parent_name:
+                    # Only index the tree's nodes if something actually changed
+                    if nodes is None:
+                        nodes = { n.name : n for n in tree.nodes }
+                    relink_object_node( tree, obj, parent_name, nodes )
+                    known[ obj.name ] = parent_name
+    finally:
+        syncing = False
+
+def remove_objects_from_trees( names ):
+    """ Remove the nodes of the given objects from all hierarchy trees """
+    global syncing
+
+    syncing = True
+    try:
+        for tree in bpy.data.node_groups:
+            if tree.bl_idname != 'CustomTreeType':
+                continue
+
+            known = get_known_parents( tree )
+            for node in [
+                n for n in tree.nodes if getattr( n, 'object_name', '' ) in names
+            ]:
+                known.pop( node.object_name, None )
+                tree.nodes.remove( node )
+    finally:
+        syncing = False
+
+def get_descendants( children, roots ):
+    """ Return the names of all descendants of the given objects, using a
+    parent --> children index (see build_parent_index) """
+    descendants = []
+    stack       = list( roots )
+    while stack:
+        kids = children.get( stack.pop(), [] )
+        descendants.extend( kids )
+        stack.extend( kids )
+
+    return descendants
+
+def select_object( obj, state ):
+    """ Select or deselect an object (select_set replaced select in 2.8) """
+    if hasattr( obj, 'select_set' ):
+        obj.select_set( state )
+    else:
+        obj.select = state
+
+def remove_objects( objs ):
+    """ Delete objects in one go where the API allows it """
+    if hasattr( bpy.data, 'batch_remove' ):
+        bpy.data.batch_remove( objs )
+        return
+
+    for obj in objs:
+        for scene in obj.users_scene:
+            scene.objects.unlink( obj )
+        bpy.data.objects.remove( obj )
+
+@persistent
+def hierarchy_scene_update( scene, depsgraph = None ):
+    """ Scene update handler: flush queued parent changes, then pick up
+    parent changes made outside of the node editor """
+    if syncing:
+        return
+
+    if pending_parents:
+        apply_pending_parents()
+
+    if depsgraph is not None:
+        changed = [
+            u.id.original for u in depsgraph.updates
+            if isinstance( u.id, bpy.types.Object ) and u.is_updated_transform
+        ]
+    elif bpy.data.objects.is_updated:
+        changed = [ o for o in scene.objects if o.is_updated ]
+    else:
+        changed = []
+
+    if changed:
+        sync_objects_to_trees( changed )
+
+def get_update_handlers():
+    """ Blender 2.8 replaced scene_update_post with depsgraph_update_post """
+    handlers = bpy.app.handlers
+    if hasattr( handlers, 'depsgraph_update_post' ):
+        return handlers.depsgraph_update_post
+    return handlers.scene_update_post
 
 
 # Shortcut for node type menu
 def add_nodetype(layout, type):
     layout.operator("node.add_node", text=type.bl_label).type = type.bl_rna.identifier
 
-# Derived from the NodeTree base type, similar to Menu, Operator, Panel, etc.
 class MyCustomTree(bpy.types.NodeTree):
-    # Description string
-    '''A custom node tree type that will show up in the node editor header'''
-    # Optional identifier string. If not explicitly defined, the python class name is used.
+    '''Hypergraph-like view of the scene's object parenting'''
     bl_idname = 'CustomTreeType'
-    # Label for nice name display
-    bl_label = 'Custom Node Tree'
-    # Icon identifier
-    # NOTE: If no icon is defined, the node tree will not show up in the editor header!
-    #       This can be used to make additional tree types for groups and similar nodes (see below)
-    #       Only one base tree class is needed in the editor for selecting the general category
-    bl_icon = 'NODETREE'
+    bl_label  = 'Hierarchy Tree'
+    bl_icon   = 'OOPS'
+
+    def update(self):
+        # Called whenever links are added or removed in the editor
+        if not syncing:
+            queue_tree_changes( self )
 
     def draw_add_menu(self, context, layout):
-        layout.label("Hello World!")
         add_nodetype(layout, bpy.types.CustomNodeType)
         add_nodetype(layout, bpy.types.MyCustomGroup)
 
 
-# Custom socket type
 class MyCustomSocket(bpy.types.NodeSocket):
-    # Description string
-    '''Custom node socket type'''
-    # Optional identifier string. If not explicitly defined, the python class name is used.
+    '''Parenting relationship socket'''
     bl_idname = 'CustomSocketType'
-    # Label for nice name display
-    bl_label = 'Custom Node Socket'
-
-    # Enum items list
-    my_items = [
-        ("DOWN", "Down", "Where your feet are"),
-        ("UP", "Up", "Where your head should be"),
-        ("LEFT", "Left", "Not right"),
-        ("RIGHT", "Right", "Not left")
-    ]
-
-    myEnumProperty = bpy.props.EnumProperty(name="Direction", description="Just an example", items=my_items, default='UP')
+    bl_label  = 'Parenting Socket'
 
-    # Optional function for drawing the socket input value
     def draw(self, context, layout, node, text):
-        if self.is_linked:
-            layout.label(text)
-        else:
-            layout.prop(self, "myEnumProperty", text=text)
+        layout.label(text)
 
-    # Socket color
     def draw_color(self, context, node):
         return (1.0, 0.4, 0.216, 0.5)
 
@@ -108,89 +419,285 @@ class MyCustomTreeNode :
     def poll(cls, ntree):
         return ntree.bl_idname == 'CustomTreeType'
 
-# Derived from the Node base type.
 class MyCustomNode(bpy.types.Node, MyCustomTreeNode):
-    # === Basics ===
-    # Description string
-    '''A custom node'''
-    # Optional identifier string. If not explicitly defined, the python class name is used.
+    '''An object in the parenting hierarchy'''
     bl_idname = 'CustomNodeType'
-    # Label for nice name display
-    bl_label = 'Custom Node'
-    # Icon identifier
-    bl_icon = 'SOUND'
-
-    # === Custom Properties ===
-    # These work just like custom properties in ID data blocks
-    # Extensive information can be found under
-    # http://wiki.blender.org/index.php/Doc:2.6/Manual/Extensions/Python/Properties
-    myStringProperty = bpy.props.StringProperty()
-    myFloatProperty = bpy.props.FloatProperty(default=3.1415926)
-
-    # === Optional Functions ===
-    # Initialization function, called when a new node is created.
-    # This is the most common place to create the sockets for a node, as shown below.
-    # NOTE: this is not the same as the standard __init__ function in Python, which is
-    #       a purely internal Python method and unknown to the node system!
-    def init(self, context):
-        self.inputs.new('CustomSocketType', "Hello")
-        self.inputs.new('NodeSocketFloat', "World")
-        self.inputs.new('NodeSocketVector', "!")
-
-        self.outputs.new('NodeSocketColor', "How")
-        self.outputs.new('NodeSocketColor', "are")
-        self.outputs.new('NodeSocketFloat', "you")
+    bl_label  = 'Object'
+    bl_icon   = 'OBJECT_DATA'
 
-    # Copy function to initialize a copied node from an existing one.
-    def copy(self, node):
-        print("Copying from node ", node)
+    object_name = bpy.props.StringProperty(
+        name        = "Object",
+        description = "Name of the object this node represents"
+    )
 
-    # Free function to clean up on removal.
-    def free(self):
-        print("Removing node ", self, ", Goodbye!")
+    def init(self, context):
+        # A minimal fixed layout: one parent input and one children output,
+        # so links can be dragged right away
+        ensure_socket( self, False )
+        ensure_socket( self, True  )
 
-    # Additional buttons displayed on the node.
     def draw_buttons(self, context, layout):
-        layout.label("Node settings")
-        layout.prop(self, "myFloatProperty")
+        # Object properties are read from the object itself rather than
+        # duplicated on the node
+        obj = bpy.data.objects.get( self.object_name )
+        if obj:
+            layout.label( obj.name, icon = 'OUTLINER_OB_' + obj.type )
+        else:
+            layout.label( self.object_name + " (missing)", icon = 'ERROR' )
 
-    # Detail buttons in the sidebar.
-    # If this function is not defined, the draw_buttons function is used instead
     def draw_buttons_ext(self, context, layout):
-        layout.prop(self, "myFloatProperty")
-        # myStringProperty button will only be visible in the sidebar
-        layout.prop(self, "myStringProperty")
+        layout.prop(self, "object_name")
+
+        obj = bpy.data.objects.get( self.object_name )
+        if obj:
+            layout.prop( obj, "name" )
+            layout.prop( obj, "hide" )
+            layout.prop( obj, "hide_render" )
 
 
 # A customized group-like node.
 class MyCustomGroup(bpy.types.NodeGroup, MyCustomTreeNode):
-    # === Basics ===
-    # Description string
-    '''A custom group node'''
-    # Label for nice name display
-    bl_label = 'Custom Group Node'
+    '''A group of hierarchy nodes'''
+    bl_label = 'Hierarchy Group'
     bl_group_tree_idname = 'CustomTreeType'
 
-    orks = bpy.props.IntProperty(default=3)
-    dwarfs = bpy.props.IntProperty(default=12)
-    wizards = bpy.props.IntProperty(default=1)
-
-    # Additional buttons displayed on the node.
     def draw_buttons(self, context, layout):
-        col = layout.column(align=True)
-        col.prop(self, "orks")
-        col.prop(self, "dwarfs")
-        col.prop(self, "wizards")
-
-        layout.label("The Node Tree:")
         layout.prop(self, "node_tree", text="")
 
 
+class build_hierarchy( bpy.types.Operator ):
+    """ Rebuild the hierarchy tree from the scene's object parenting """
+    bl_idname      = "node.build_hierarchy"
+    bl_label       = "Build Hierarchy"
+    bl_description = "Build a node tree representing the scene's object parenting"
+    bl_options     = {'REGISTER', 'UNDO' }
+
+    @classmethod
+    def poll( self, context ):
+        space = context.space_data
+        return space.type == 'NODE_EDITOR' and space.tree_type == 'CustomTreeType'
+
+    def execute( self, context ):
+        space = context.space_data
+        tree  = space.node_tree
+
+        if not tree:
+            tree = bpy.data.node_groups.new( 'Hierarchy', 'CustomTreeType' )
+            space.node_tree = tree
+
+        nodes = build_hierarchy_tree( tree, context.scene.objects )
+        self.report( {'INFO'}, "Created %d object nodes" % len( nodes ) )
+
+        return {'FINISHED'}
+
+class add_hierarchy_sockets( bpy.types.Operator ):
+    """ Add parent and children sockets to the selected nodes that lack them
+    (nodes of trees built by older versions), so they can be linked """
+    bl_idname      = "node.add_hierarchy_sockets"
+    bl_label       = "Add Sockets"
+    bl_description = "Add parenting sockets to the selected nodes"
+    bl_options     = {'REGISTER', 'UNDO' }
+
+    @classmethod
+    def poll( self, context ):
+        tree = context.space_data.node_tree
+        return tree and tree.bl_idname == 'CustomTreeType'
+
+    def execute( self, context ):
+        for node in context.space_data.node_tree.nodes:
+            if node.select and node.bl_idname == 'CustomNodeType':
+                ensure_socket( node, False )
+                ensure_socket( node, True  )
+                node.hide = False
+
+        return {'FINISHED'}
+
+class hierarchy_branch_operator:
+    """ Base class for operators acting on the branches (subtrees) of the
+    objects whose nodes are selected in the hierarchy tree """
+    bl_options = {'REGISTER', 'UNDO' }
+
+    @classmethod
+    def poll( self, context ):
+        tree = context.space_data.node_tree
+        return tree and tree.bl_idname == 'CustomTreeType'
+
+    def get_objects( self ):
+        return map_objects( bpy.data.objects )
+
+    def get_selected_objects( self, context, objs ):
+        return [
+            n.object_name for n in context.space_data.node_tree.nodes
+            if n.select and getattr( n, 'object_name', '' ) in objs
+        ]
+
+    def get_index( self, context ):
+        return build_parent_index( context.scene.objects )
+
+class select_hierarchy_branch( hierarchy_branch_operator, bpy.types.Operator ):
+    """ Select the objects (and nodes) of the selected nodes' subtrees """
+    bl_idname      = "node.select_hierarchy_branch"
+    bl_label       = "Select Branch"
+    bl_description = "Select all descendants of the selected objects"
+
+    def execute( self, context ):
+        objs        = self.get_objects()
+        roots       = self.get_selected_objects( context, objs )
+        children, _ = self.get_index( context )
+        names       = set( roots + get_descendants( children, roots ) )
+
+        for name in names:
+            select_object( objs[ name ], True )
+
+        for node in context.space_data.node_tree.nodes:
+            if getattr( node, 'object_name', '' ) in names:
+                node.select = True
+
+        self.report( {'INFO'}, "Selected %d objects" % len( names ) )
+        return {'FINISHED'}
+
+class reparent_hierarchy_branch( hierarchy_branch_operator, bpy.types.Operator ):
+    """ Parent the selected nodes' objects to the active node's object """
+    bl_idname      = "node.reparent_hierarchy_branch"
+    bl_label       = "Parent to Active"
+    bl_description = "Parent the selected objects to the active node's object"
+
+    @classmethod
+    def poll( self, context ):
+        tree = context.space_data.node_tree
+        return tree and tree.bl_idname == 'CustomTreeType' and tree.nodes.active
+
+    def execute( self, context ):
+        objs   = self.get_objects()
+        parent = context.space_data.node_tree.nodes.active.object_name
+        if parent not in objs:
+            self.report( {'ERROR'}, "The active node's object doesn't exist" )
+            return {'CANCELLED'}
+
+        # Objects the new parent descends from can't be parented to it
+        ancestors = set()
+        obj       = objs[ parent ].parent
+        while obj:
+            ancestors.add( obj.name )
+            obj = obj.parent
+
+        changes = {
+            name : parent for name in self.get_selected_objects( context, objs )
+            if name != parent and name not in ancestors
+        }
+
+        skipped = set_parents_keep_transform( changes )
+        sync_objects_to_trees( [ objs[ n ] for n in changes ] )
+
+        if skipped:
+            self.report( {'WARNING'}, "Can't parent to a zero scale object, %d objects skipped" % len( skipped ) )
+        else:
+            self.report( {'INFO'}, "Parented %d objects" % len( changes ) )
+        return {'FINISHED'}
+
+class unparent_hierarchy_branch( hierarchy_branch_operator, bpy.types.Operator ):
+    """ Clear the parent of the selected nodes' objects """
+    bl_idname      = "node.unparent_hierarchy_branch"
+    bl_label       = "Clear Parent"
+    bl_description = "Clear the parent of the selected objects, keeping transforms"
+
+    def execute( self, context ):
+        objs    = self.get_objects()
+        changes = dict.fromkeys( self.get_selected_objects( context, objs ) )
+
+        set_parents_keep_transform( changes )
+        sync_objects_to_trees( [ objs[ n ] for n in changes ] )
+
+        self.report( {'INFO'}, "Unparented %d objects" % len( changes ) )
+        return {'FINISHED'}
+
+class flatten_hierarchy_branch( hierarchy_branch_operator, bpy.types.Operator ):
+    """ Parent all descendants of the selected nodes' objects directly to them """
+    bl_idname      = "node.flatten_hierarchy_branch"
+    bl_label       = "Flatten Branch"
+    bl_description = "Parent all descendants directly to the selected objects"
+
+    def execute( self, context ):
+        objs        = self.get_objects()
+        children, _ = self.get_index( context )
+
+        # Deepest roots first, so that the descendants of nested selected
+        # roots go to their nearest selected ancestor
+        roots = sorted(
+            self.get_selected_objects( context, objs ),
+            key     = lambda n: get_depth( objs[n] ),
+            reverse = True
+        )
+
+        changes = {}
+        for root in roots:
+            for name in get_descendants( children, [ root ] ):
+                changes.setdefault( name, root )
+
+        skipped = set_parents_keep_transform( changes )
+        sync_objects_to_trees( [ objs[ n ] for n in changes ] )
+
+        if skipped:
+            self.report( {'WARNING'}, "Can't parent to a zero scale object, %d objects skipped" % len( skipped ) )
+        else:
+            self.report( {'INFO'}, "Flattened %d objects" % len( changes ) )
+        return {'FINISHED'}
+
+class delete_hierarchy_branch( hierarchy_branch_operator, bpy.types.Operator ):
+    """ Delete the selected nodes' objects along with all their descendants """
+    bl_idname      = "node.delete_hierarchy_branch"
+    bl_label       = "Delete Branch"
+    bl_description = "Delete the selected objects and all their descendants"
+
+    def execute( self, context ):
+        objs        = self.get_objects()
+        roots       = self.get_selected_objects( context, objs )
+        children, _ = self.get_index( context )
+        names       = set( roots + get_descendants( children, roots ) )
+
+        remove_objects_from_trees( names )
+        remove_objects( [ objs[ n ] for n in names ] )
+
+        self.report( {'INFO'}, "Deleted %d objects" % len( names ) )
+        return {'FINISHED'}
+
+class hierarchy_panel( bpy.types.Panel ):
+    bl_idname      = "HierarchyPanel"
+    bl_label       = "Hierarchy"
+    bl_space_type  = 'NODE_EDITOR'
+    bl_region_type = 'TOOLS'
+
+    @classmethod
+    def poll( self, context ):
+        return context.space_data.tree_type == 'CustomTreeType'
+
+    def draw( self, context ):
+        layout = self.layout
+        layout.operator( 'node.build_hierarchy', icon = 'FILE_REFRESH' )
+        layout.operator( 'node.add_hierarchy_sockets' )
+
+        col = layout.column( align = True )
+        col.operator( 'node.select_hierarchy_branch' )
+        col.operator( 'node.reparent_hierarchy_branch' )
+        col.operator( 'node.unparent_hierarchy_branch' )
+        col.operator( 'node.flatten_hierarchy_branch' )
+        col.operator( 'node.delete_hierarchy_branch', icon = 'X' )
+
+
 def register():
     bpy.utils.register_class(MyCustomTree)
     bpy.utils.register_class(MyCustomSocket)
     bpy.utils.register_class(MyCustomNode)
     bpy.utils.register_class(MyCustomGroup)
+    bpy.utils.register_class(build_hierarchy)
+    bpy.utils.register_class(add_hierarchy_sockets)
+    bpy.utils.register_class(select_hierarchy_branch)
+    bpy.utils.register_class(reparent_hierarchy_branch)
+    bpy.utils.register_class(unparent_hierarchy_branch)
+    bpy.utils.register_class(flatten_hierarchy_branch)
+    bpy.utils.register_class(delete_hierarchy_branch)
+    bpy.utils.register_class(hierarchy_panel)
+    get_update_handlers().append( hierarchy_scene_update )
 
 
 def unregister():
@@ -198,6 +705,16 @@ def unregister():
     bpy.utils.unregister_class(MyCustomSocket)
     bpy.utils.unregister_class(MyCustomNode)
     bpy.utils.unregister_class(MyCustomGroup)
+    bpy.utils.unregister_class(build_hierarchy)
+    bpy.utils.unregister_class(add_hierarchy_sockets)
+    bpy.utils.unregister_class(select_hierarchy_branch)
+    bpy.utils.unregister_class(reparent_hierarchy_branch)
+    bpy.utils.unregister_class(unparent_hierarchy_branch)
+    bpy.utils.unregister_class(flatten_hierarchy_branch)
+    bpy.utils.unregister_class(delete_hierarchy_branch)
+    bpy.utils.unregister_class(hierarchy_panel)
+    if hierarchy_scene_update in get_update_handlers():
+        get_update_handlers().remove( hierarchy_scene_update )
 
 
 if __name__ == "__main__":
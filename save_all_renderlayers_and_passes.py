@@ -43,7 +43,1084 @@ bl_info = {
     "description": "Save all render layers and passes to files in respectively named folders."
 }
 
-import bpy, re
+import bpy, bmesh, re, os, sys, time, json, shutil, string, argparse, subprocess, tempfile, multiprocessing
+from collections import OrderedDict
+from bpy.app.handlers import persistent
+
+pass_attr_str = 'use_pass_'
+
+# Renderlayer pass names and renderlayer node output names do not match
+# which is why we're using this dictionary (and a naming heuristic) to match
+# the two
+output_dict = {
+    'ambient_occlusion' : 'AO',
+    'material_index'    : 'IndexMA',
+    'object_index'      : 'IndexOB',
+    'reflection'        : 'Reflect',
+    'refraction'        : 'Refract',
+    'combined'          : 'Image',
+    'uv'                : 'UV'
+}
+
+# Pass groups that can be saved to separate multilayer files, each with its
+# own compression settings. Passes not listed here are 'beauty' passes.
+# When groups share a file, the strictest group (listed first) decides
+# the file's codec
+pass_groups = [ 'crypto', 'data', 'beauty' ]
+
+# EXR codecs the pass groups can use (see set_exr_format for versions
+# missing some of them)
+exr_codecs = [
+    ( 'DWAA',  'DWAA',  'Lossy, fast and small' ),
+    ( 'ZIP',   'ZIP',   'Lossless' ),
+    ( 'PIZ',   'PIZ',   'Lossless, good for noisy images' ),
+    ( 'PXR24', 'Pxr24', 'Lossy for float, lossless for half' ),
+    ( 'NONE',  'None',  'Uncompressed' )
+]
+
+data_passes = {
+    'z', 'mist', 'normal', 'vector', 'uv', 'object_index', 'material_index',
+    'position'
+}
+
+def get_pass_group( pass_name ):
+    if 'crypto' in pass_name:
+        return 'crypto'
+    elif pass_name in data_passes:
+        return 'data'
+    return 'beauty'
+
+# Default file path templates
+# Example: Scene/RenderLayer/ambient_occlusion/RenderLayer_ambient_occlusion
+folder_template = "{scene}/{layer}/{pass}/{layer}_{pass}"
+# Example: basename_RenderLayer_ambient_occlusion
+file_template   = "{base}_{layer}_{pass}"
+
+# Compiled path templates, keyed by template string
+path_templates = {}
+
+class path_template:
+    """ A file path template such as {scene}/{layer}/{pass}/{layer}_{pass},
+    parsed once into literal text and fields. A {frame} field becomes the
+    '#' frame number placeholder of file output paths, padded to the field's
+    width (i.e. {frame:04d} --> ####) """
+    fields = ( 'scene', 'layer', 'pass', 'base', 'group' )
+
+    def __init__( self, template ):
+        self.template = template
+        self.parts    = []
+
+        for literal, field, spec, conversion in string.Formatter().parse( template ):
+            if field == 'frame':
+                digits  = re.match( r'0?(\d*)', spec or '' ).group( 1 )
+                literal = literal + '#' * int( digits or 1 )
+                field   = None
+            elif field is not None and field not in self.fields:
+                raise ValueError( "Unknown path template field: {%s}" % field )
+
+            self.parts.append( ( literal, field, spec or '' ) )
+
+    def format( self, values ):
+        return "".join( [
+            literal + ( format( values[ field ], spec ) if field else '' )
+            for literal, field, spec in self.parts
+        ] )
+
+def get_path_template( template ):
+    """ Return the compiled version of a template string """
+    if template not in path_templates:
+        path_templates[ template ] = path_template( template )
+    return path_templates[ template ]
+
+def find_path_collisions( paths ):
+    """ Return the paths used more than once (ignoring case, for the sake of
+    case insensitive file systems) """
+    seen       = set()
+    collisions = set()
+    for path in paths:
+        key = os.path.normcase( os.path.normpath( path ) ).lower()
+        if key in seen:
+            collisions.add( path )
+        seen.add( key )
+
+    return sorted( collisions )
+
+# Blend file name pattern, and the base name found for each blend file path
+blendfile_pattern = re.compile( r'^([\d\w_-]+)(\.blend)$' )
+base_names        = {}
+
+# Render pass schemas, keyed by blender version. Each schema maps a pass name
+# to its render layer attribute, renderlayer node output (socket) name and
+# pass group
+pass_schemas = {}
+
+# Blender versions whose schema was checked against a renderlayer node
+validated_versions = set()
+
+def guess_output_name( pass_name ):
+    """ Derive the renderlayer node output name from a render pass name """
+    if pass_name in output_dict:
+        return output_dict[ pass_name ]
+    elif "_" in pass_name:
+        wl = pass_name.split("_") # Split to list of words
+        # Capitalize first char in each word and rejoin with spaces
+        return " ".join([ s[0].capitalize() + s[1:] for s in wl ])
+    else: # If one word, just capitlaize first letter
+        return pass_name[0].capitalize() + pass_name[1:]
+
+def get_pass_schema():
+    """ Return the render pass schema of the running blender version, building
+    it on first use from the render layer type's RNA definition """
+    version = bpy.app.version
+    if version in pass_schemas:
+        return pass_schemas[ version ]
+
+    # SceneRenderLayer was replaced by ViewLayer in 2.80
+    layer_type = getattr( bpy.types, 'SceneRenderLayer', None )
+    if layer_type is None:
+        layer_type = bpy.types.ViewLayer
+
+    pass_attrs = sorted( [
+        p.identifier for p in layer_type.bl_rna.properties
+        if p.identifier.startswith( pass_attr_str ) and p.type == 'BOOLEAN'
+    ] )
+
+    # Keep passes ordered by name so output slots are created in a stable order
+    schema = OrderedDict()
+    for attr in pass_attrs:
+        pass_name = attr[ len( pass_attr_str ): ]
+        schema[ pass_name ] = {
+            'attr'   : attr,
+            'output' : guess_output_name( pass_name ),
+            'group'  : get_pass_group( pass_name )
+        }
+
+    pass_schemas[ version ] = schema
+
+    return schema
+
+def simplify_name( name ):
+    """ Lowercase a pass or output name and strip its spaces and underscores,
+    to match names that only differ in style """
+    return name.lower().replace( " ", "" ).replace( "_", "" )
+
+# Channels in each type of renderlayer node output
+socket_channels = { 'RGBA' : 4, 'VECTOR' : 3, 'VALUE' : 1 }
+
+def validate_pass_schema( tree, node_type ):
+    """ Check the schema's output names against a (temporary) renderlayer
+    node's actual outputs, once per session. Outputs that don't match the
+    naming heuristic are matched while ignoring case, spaces and underscores,
+    and passes with no matching output are left without one (and so aren't
+    saved, see get_layers_and_passes) """
+    schema = get_pass_schema()
+    if bpy.app.version in validated_versions:
+        return schema
+
+    node    = tree.nodes.new( type = node_type )
+    outputs = { simplify_name( o.name ) : o.name for o in node.outputs }
+
+    for pass_name, info in schema.items():
+        if info['output'] not in node.outputs:
+            info['output'] = outputs.get(
+                simplify_name( info['output'] ),
+                outputs.get( simplify_name( pass_name ), '' )
+            )
+
+        # Remember the number of channels, to estimate file sizes
+        if info['output']:
+            socket_type      = node.outputs[ info['output'] ].type
+            info['channels'] = socket_channels.get( socket_type, 4 )
+
+    tree.nodes.remove( node )
+    validated_versions.add( bpy.app.version )
+
+    return schema
+
+# Pass manifests, keyed by file path: ( modification time, manifest )
+pass_manifests = {}
+
+# Rough EXR compression ratios, used to estimate file sizes
+codec_ratios = { 'NONE' : 1.0, 'ZIP' : 2.0, 'PIZ' : 2.2, 'PXR24' : 2.5, 'DWAA' : 5.0 }
+
+def load_pass_manifest( path ):
+    """ Load a JSON manifest of the passes used by the comp templates:
+        { "passes" : [ "combined", "z" ],                  (used on all layers)
+          "layers" : { "FG" : [ "cryptomatte_object" ] } }  (used on some layers)
+    Pass and renderlayer output names are both accepted. The manifest is
+    only read again when the file changes. Raises ValueError for malformed
+    manifests """
+    path  = bpy.path.abspath( path )
+    mtime = os.path.getmtime( path )
+    if path in pass_manifests and pass_manifests[ path ][0] == mtime:
+        return pass_manifests[ path ][1]
+
+    with open( path ) as f:
+        data = json.load( f )
+
+    # Raised as ValueError, like JSON errors, for the callers to report
+    if not isinstance( data, dict ):
+        raise ValueError( "Pass manifest must be a JSON object: " + path )
+    if not isinstance( data.get( 'passes', [] ), list ) or \
+       not isinstance( data.get( 'layers', {} ), dict ) or \
+       not all( [ isinstance( p, list ) for p in data.get( 'layers', {} ).values() ] ):
+        raise ValueError( "Pass manifest needs a list of passes and lists of passes per layer: " + path )
+
+    manifest = {
+        'all'    : set( [ simplify_name( p ) for p in data.get( 'passes', [] ) ] ),
+        'layers' : dict( [
+            ( layer, set( [ simplify_name( p ) for p in passes ] ) )
+            for layer, passes in data.get( 'layers', {} ).items()
+        ] )
+    }
+    pass_manifests[ path ] = ( mtime, manifest )
+
+    return manifest
+
+def is_pass_used( manifest, layer, pass_name ):
+    used = manifest['all'] | manifest['layers'].get( layer, set() )
+    info = get_pass_schema()[ pass_name ]
+    return simplify_name( pass_name ) in used or simplify_name( info['output'] ) in used
+
+def find_unused_passes( scene, manifest ):
+    """ List the ( layer, pass name ) of enabled passes the manifest doesn't use """
+    schema = get_pass_schema()
+    return [
+        ( l.name, pass_name ) for l in scene.render.layers
+        for pass_name, info in schema.items()
+        if getattr( l, info['attr'] ) and not is_pass_used( manifest, l.name, pass_name )
+    ]
+
+def estimate_pass_bytes( scene, pass_name ):
+    """ Estimate the size of a pass in one frame from the render resolution,
+    the pass's channels and its group's bit depth and codec """
+    render   = scene.render
+    info     = get_pass_schema()[ pass_name ]
+    settings = getattr( scene.pass_group_props, info['group'] )
+    pixels   = render.resolution_x * render.resolution_y * \
+               ( render.resolution_percentage / 100.0 ) ** 2
+    depth    = int( settings.depth ) // 8
+
+    return pixels * info.get( 'channels', 4 ) * depth / codec_ratios.get( settings.codec, 1.0 )
+
+def get_write_throughput( scene ):
+    """ Average bytes written per second by the file output nodes, from the
+    render log (see log_render_post), or None if there's no log or no frame
+    with several output files. The first file of each frame is left out, its
+    write isn't part of the frame's write span """
+    folder = os.path.dirname( bpy.path.abspath( scene.render.filepath ) )
+    path   = os.path.join( folder, 'render_log.jsonl' )
+    if not os.path.exists( path ):
+        return None
+
+    total_bytes = total_time = 0.0
+    with open( path ) as log:
+        for line in log:
+            entry = json.loads( line )
+            if not entry.get( 'write_span' ):
+                continue
+            files        = sorted( entry['files'], key = lambda f: f['mtime'] )
+            total_bytes += sum( f['bytes'] for f in files[1:] )
+            total_time  += entry['write_span']
+
+    return total_bytes / total_time if total_time else None
+
+# Scene property recording the nodes created by the add-on, so that they can
+# be updated (rather than duplicated) when the add-on is run again
+managed_nodes_prop = 'save_passes_nodes'
+
+def get_slot_keys( node ):
+    """ List the identifying names of a file output node's slots: layer names
+    in multilayer files, file paths otherwise """
+    if node.format.file_format == 'OPEN_EXR_MULTILAYER' and \
+       hasattr( node, 'layer_slots' ):
+        return [ s.name for s in node.layer_slots ]
+    return [ s.path for s in node.file_slots ]
+
+# Approximate node sizes, used to lay nodes out before the node editor has
+# drawn them (node.dimensions is only known after drawing)
+node_header_height = 40
+node_socket_height = 22
+node_spacing       = 30
+column_spacing     = 80
+group_spacing      = 80
+
+def estimate_node_height( node ):
+    if getattr( node, 'hide', False ):
+        return node_header_height  # Collapsed
+
+    sockets = [
+        s for s in list( node.inputs ) + list( node.outputs )
+        if getattr( s, 'enabled', True )
+    ]
+    return node_header_height + node_socket_height * len( sockets )
+
+def layout_node_groups( groups, origin = ( 0, 0 ), spacing = None ):
+    """ Lay out groups of nodes one under the other, without overlaps,
+    starting at origin (the top left corner of the first group).
+    Each group is a ( label, columns, frame ) tuple, where columns is a list
+    of node lists. A group's columns are placed left to right, and the nodes
+    of each column stacked top to bottom. Column widths are shared by all
+    groups, so columns line up. If a group has a frame node, the group's
+    nodes are parented to it and it's labeled. spacing is a ( node, column,
+    group ) tuple of gaps, defaulting to this add-on's.
+    Node sizes are estimated from socket counts, and nothing is assumed
+    about the nodes' types or names, so this works on any node tree """
+    node_gap, column_gap, group_gap = spacing or ( node_spacing, column_spacing, group_spacing )
+
+    widths = {}
+    for label, columns, frame in groups:
+        for i, column in enumerate( columns ):
+            for node in column:
+                widths[i] = max( widths.get( i, 0 ), node.width )
+
+    y = origin[1]
+    for label, columns, frame in groups:
+        if frame:
+            frame.label    = label
+            frame.location = origin
+            for column in columns:
+                for node in column:
+                    node.parent = frame
+
+        x      = origin[0]
+        height = 0
+        for i, column in enumerate( columns ):
+            column_y = y
+            for node in column:
+                node.location = x, column_y
+                column_y     -= estimate_node_height( node ) + node_gap
+
+            height = max( height, y - column_y )
+            x     += widths.get( i, 0 ) + column_gap
+
+        y -= height + group_gap
+
+def sync_output_nodes( scene, spec, sync = True ):
+    """ Make the compositor tree match the output spec. With sync turned on,
+    nodes created by a previous run are diffed against the spec: stale nodes
+    and slots are removed, missing ones added and only wrong links are
+    relinked. Otherwise a complete new set of nodes is added """
+    tree    = scene.node_tree
+    links   = tree.links
+    types   = spec['types']
+    stats   = { 'added' : 0, 'removed' : 0, 'relinked' : 0 }
+
+    # Blender 2.66 and below can't add or remove file output slots
+    slot_api = bpy.app.version[:2] > ( 2, 66 )
+
+    managed = {}
+    if sync and managed_nodes_prop in scene:
+        managed = scene[ managed_nodes_prop ].to_dict()
+
+    wanted = spec['layers'] + list( spec['outputs'] ) + [ 'composite' ]
+    if types.get( 'FR' ):
+        wanted += [ 'frame ' + rl for rl in spec['layers'] ] + [ 'frame outputs' ]
+
+    # Remove nodes created by a previous run that aren't needed anymore
+    for key in set( managed ).difference( wanted ):
+        if managed[ key ] in tree.nodes:
+            tree.nodes.remove( tree.nodes[ managed[ key ] ] )
+            stats['removed'] += 1
+
+    created = {}
+    def get_node( key, node_type ):
+        """ Reuse a node from a previous run, or create a new one """
+        if key in managed and managed[ key ] in tree.nodes:
+            node = tree.nodes[ managed[ key ] ]
+        else:
+            node       = tree.nodes.new( type = node_type )
+            node.label = key
+            node.name  = key
+            stats['added'] += 1
+
+        created[ key ] = node.name
+        return node
+
+    rl_nodes = {}
+    for i, rl in enumerate( spec['layers'] ):
+        node       = get_node( rl, types['RL'] )
+        node.layer = rl
+        rl_nodes[ rl ] = node
+
+    of_nodes = {}
+    for name, out in spec['outputs'].items():
+        is_new = name not in managed or managed[ name ] not in tree.nodes
+        node   = get_node( name, types['OF'] )
+        of_nodes[ name ] = node
+
+        if is_new and slot_api:
+            node.file_slots.clear()
+
+        node.base_path = out['base_path']
+        if out['multilayer']:
+            node.format.file_format = 'OPEN_EXR_MULTILAYER'
+            set_exr_format( node.format, out['codec'], out['depth'] )
+        elif node.format.file_format == 'OPEN_EXR_MULTILAYER':
+            # A node reused from a multilayer run
+            node.format.file_format = 'OPEN_EXR'
+
+        key_type = 'name' if out['multilayer'] else 'path'
+        wanted_keys = [ slot[ key_type ] for slot in out['slots'] ]
+
+        if slot_api:
+            # Remove stale slots, then add the missing ones
+            for idx, key in reversed( list( enumerate( get_slot_keys( node ) ) ) ):
+                if key not in wanted_keys:
+                    node.file_slots.remove( node.inputs[ idx ] )
+
+            existing = get_slot_keys( node )
+            for slot in out['slots']:
+                if slot[ key_type ] not in existing:
+                    node.file_slots.new( slot['name'] )
+                    node.file_slots[-1].path = slot['path']
+        else:
+            node.file_slots[0].path = out['slots'][0]['path']
+
+        # Only link the slots that aren't already linked to the right output
+        keys = get_slot_keys( node )
+        for slot in out['slots']:
+            socket_out = rl_nodes[ slot['layer'] ].outputs.get( slot['output'] )
+            if not socket_out or slot[ key_type ] not in keys:
+                continue
+
+            socket_in = node.inputs[ keys.index( slot[ key_type ] ) ]
+            if not socket_in.links or socket_in.links[0].from_socket != socket_out:
+                links.new( socket_out, socket_in )
+                stats['relinked'] += 1
+
+    # Create composite node, just to enable rendering, and link it with the
+    # last render layer
+    if rl_nodes:
+        cnode   = get_node( 'composite', types['OC'] )
+        last_rl = rl_nodes[ spec['layers'][-1] ]
+        if not cnode.inputs[0].links:
+            links.new( last_rl.outputs[ 'Image' ], cnode.inputs[0] )
+
+    # Lay out and frame the nodes of each render layer: the renderlayer node
+    # next to the output nodes only it feeds. Outputs shared by several
+    # layers go in a group of their own, with the composite node
+    def get_frame( key ):
+        return get_node( key, types['FR'] ) if types.get( 'FR' ) else None
+
+    groups = []
+    for rl in spec['layers']:
+        own_outputs = [
+            of_nodes[ name ] for name, out in spec['outputs'].items()
+            if set( [ slot['layer'] for slot in out['slots'] ] ) == { rl }
+        ]
+        groups.append( ( rl, [ [ rl_nodes[ rl ] ], own_outputs ], get_frame( 'frame ' + rl ) ) )
+
+    shared_outputs = [
+        of_nodes[ name ] for name, out in spec['outputs'].items()
+        if len( set( [ slot['layer'] for slot in out['slots'] ] ) ) > 1
+    ]
+    if rl_nodes:
+        groups.append( (
+            'Outputs', [ [], shared_outputs + [ cnode ] ], get_frame( 'frame outputs' )
+        ) )
+
+    layout_node_groups( groups )
+
+    scene[ managed_nodes_prop ] = created
+
+    return stats
+
+def set_exr_format( image_format, codec, depth ):
+    """ Set the codec and bit depth of an EXR file format, falling back to
+    ZIP on versions that don't support the requested codec """
+    codecs = image_format.bl_rna.properties['exr_codec'].enum_items.keys()
+
+    image_format.exr_codec   = codec if codec in codecs else 'ZIP'
+    image_format.color_depth = depth
+
+def run_with_scene( op, scene, **kwargs ):
+    """ Run an operator with the given scene as context.scene, using a
+    context override dict. Blender 4.0 dropped those for temp_override """
+    if bpy.app.version < ( 4, 0 ):
+        override          = bpy.context.copy()
+        override['scene'] = scene
+        return op( override, **kwargs )
+
+    with bpy.context.temp_override( scene = scene ):
+        return op( **kwargs )
+
+def get_folder_stats( folder ):
+    """ Return the paths of all files under a folder and their total size """
+    paths = [
+        os.path.join( root, f ) for root, dirs, files in os.walk( folder )
+        for f in files
+    ]
+    return paths, sum( os.path.getsize( p ) for p in paths )
+
+def time_read_back( paths ):
+    """ Time loading the pixels of all image files in the list """
+    start = time.time()
+    for path in paths:
+        img = bpy.data.images.load( path )
+        try:
+            len( img.pixels )  # Accessing the pixels forces the file to be read
+        finally:
+            bpy.data.images.remove( img )
+
+    return time.time() - start
+
+def create_benchmark_scene( num_layers, num_passes, resolution ):
+    """ Create a scene with a lit sphere, rendered through the given number of
+    render layers, each with the given number of passes enabled """
+    scene = bpy.data.scenes.new( 'PassBenchmark' )
+
+    scene.render.resolution_x          = resolution
+    scene.render.resolution_y          = resolution
+    scene.render.resolution_percentage = 100
+    scene.use_nodes                    = True
+
+    bm = bmesh.new()
+    bmesh.ops.create_uvsphere( bm, u_segments = 32, v_segments = 16, diameter = 1 )
+    me = bpy.data.meshes.new( 'PassBenchmark' )
+    bm.to_mesh( me )
+    bm.free()
+
+    sphere = bpy.data.objects.new( 'PassBenchmark.Sphere', me )
+    camera = bpy.data.objects.new(
+        'PassBenchmark.Camera', bpy.data.cameras.new( 'PassBenchmark' )
+    )
+    lamp   = bpy.data.objects.new(
+        'PassBenchmark.Lamp', bpy.data.lamps.new( 'PassBenchmark', 'SUN' )
+    )
+
+    camera.location = 0, -4, 0
+    camera.rotation_euler = 1.5708, 0, 0
+    lamp.location   = 2, -2, 2
+
+    for obj in sphere, camera, lamp:
+        scene.objects.link( obj )
+    scene.camera = camera
+
+    # Enable the first passes listed in the schema on every layer
+    pass_attrs = [ info['attr'] for info in get_pass_schema().values() ]
+
+    layers = scene.render.layers
+    while len( layers ) < num_layers:
+        layers.new( 'Layer%d' % len( layers ) )
+
+    for layer in layers:
+        enabled = 0
+        for attr in pass_attrs:
+            if enabled == num_passes:
+                break
+            try:
+                setattr( layer, attr, True )
+                enabled += 1
+            except ( AttributeError, TypeError ):
+                pass # Read only or unsupported by the render engine
+
+    return scene
+
+def remove_benchmark_scene( scene ):
+    """ Remove a scene made by create_benchmark_scene, with its objects and
+    their data """
+    data_collections = {
+        'MESH'   : bpy.data.meshes,
+        'CAMERA' : bpy.data.cameras,
+        'LAMP'   : bpy.data.lamps
+    }
+
+    for obj in list( scene.objects ):
+        data = obj.data
+        scene.objects.unlink( obj )
+        if not obj.users:
+            bpy.data.objects.remove( obj )
+        if data and not data.users and obj.type in data_collections:
+            data_collections[ obj.type ].remove( data )
+
+    # The compositing node tree belongs to the scene and goes with it
+    bpy.data.scenes.remove( scene )
+
+def clear_output_nodes( scene ):
+    """ Remove all compositor nodes and the record of generated nodes """
+    for n in scene.node_tree.nodes:
+        scene.node_tree.nodes.remove( n )
+    if managed_nodes_prop in scene:
+        del scene[ managed_nodes_prop ]
+
+def benchmark_output_configs( scene, folder, codecs ):
+    """ Render the scene through every output layout and codec, and measure
+    the bytes and files written, the write time and the read-back time.
+    Write time is the render time minus that of a render without any file
+    output nodes. Per pass files are single layer EXRs """
+    known   = [ c[0] for c in exr_codecs ]
+    unknown = [ c for c in codecs if c not in known ]
+    if unknown:
+        raise ValueError( "Unknown EXR codecs: %s, use %s" % (
+            ", ".join( unknown ), ", ".join( known )
+        ) )
+
+    configs = [ ( 'per_pass', False, 'SINGLE', 'NONE' ) ]
+    for layout in 'SINGLE', 'LAYER', 'GROUP':
+        for codec in codecs:
+            configs.append( ( layout.lower() + '_' + codec, True, layout, codec ) )
+
+    clear_output_nodes( scene )
+    tree  = scene.node_tree
+    tree.links.new(
+        tree.nodes.new( type = 'CompositorNodeRLayers' ).outputs['Image'],
+        tree.nodes.new( type = 'CompositorNodeComposite' ).inputs[0]
+    )
+    start = time.time()
+    run_with_scene( bpy.ops.render.render, scene, scene = scene.name )
+    baseline = time.time() - start
+
+    results = []
+    for name, single, layout, codec in configs:
+        out_folder = os.path.join( folder, name )
+        scene.render.filepath = out_folder + os.sep
+
+        scene.file_props.single_file   = single
+        scene.file_props.output_layout = layout
+        for group in pass_groups:
+            getattr( scene.pass_group_props, group ).codec = codec
+
+        clear_output_nodes( scene )
+        run_with_scene( bpy.ops.render.create_file_output_nodes, scene )
+
+        if not single:
+            for node in scene.node_tree.nodes:
+                if node.type == 'OUTPUT_FILE':
+                    node.format.file_format = 'OPEN_EXR'
+                    set_exr_format( node.format, codec, '32' )
+
+        start = time.time()
+        run_with_scene( bpy.ops.render.render, scene, scene = scene.name )
+        render_time = time.time() - start
+
+        paths, size = get_folder_stats( out_folder )
+        results.append( {
+            'config'     : name,
+            'files'      : len( paths ),
+            'bytes'      : size,
+            'write_time' : max( render_time - baseline, 0.0 ),
+            'read_time'  : time_read_back( paths )
+        } )
+
+    return results
+
+def format_benchmark_report( results ):
+    lines = [ "%-20s %6s %12s %10s %10s" % (
+        'config', 'files', 'MB', 'write (s)', 'read (s)'
+    ) ]
+    for r in sorted( results, key = lambda r: r['write_time'] + r['read_time'] ):
+        lines.append( "%-20s %6d %12.2f %10.3f %10.3f" % (
+            r['config'], r['files'], r['bytes'] / 1048576.0,
+            r['write_time'], r['read_time']
+        ) )
+    return "\n".join( lines )
+
+# Script run by each background blender process of a parallel render. It
+# renders a single render layer, and only keeps the file outputs fed by that
+# layer. Multilayer files are written to a parts folder to be merged later.
+# The job opens a copy of the blend file saved elsewhere, so relative output
+# paths are resolved against the original file's folder. Each job's composite
+# goes to the parts folder, so jobs don't overwrite each other's images
+layer_job_template = """
+import bpy, os, sys
+
+args   = sys.argv[ sys.argv.index( '--' ) + 1: ]
+layer  = args[0]
+parts  = args[1]
+start  = args[3]
+scene  = bpy.context.scene
+
+scene.render.filepath = os.path.join( parts, 'composite', layer + '_' )
+
+for l in scene.render.layers:
+    l.use = l.name == layer
+
+scene.render.threads_mode = 'FIXED'
+scene.render.threads      = int( args[2] )
+
+tree = scene.node_tree
+rl_nodes = [ n for n in tree.nodes if n.type == 'R_LAYERS' and n.layer == layer ]
+
+for node in [ n for n in tree.nodes if n.type == 'OUTPUT_FILE' ]:
+    # Remove the inputs fed by other render layers
+    for i in reversed( range( len( node.inputs ) ) ):
+        links = node.inputs[i].links
+        if not links or links[0].from_node not in rl_nodes:
+            node.file_slots.remove( node.inputs[i] )
+
+    if not node.inputs:
+        tree.nodes.remove( node )
+    elif node.format.file_format == 'OPEN_EXR_MULTILAYER':
+        node.base_path = os.path.join( parts, node.name, layer + '_' )
+    else:
+        node.base_path = bpy.path.abspath( node.base_path, start = start )
+
+bpy.ops.render.render( animation = True )
+"""
+
+def run_blender_jobs( commands, max_jobs ):
+    """ Run background blender processes, at most max_jobs at a time.
+    Returns the return code and output of each command, in order """
+    results = [ None ] * len( commands )
+    running = []
+    queue   = list( enumerate( commands ) )
+
+    while queue or running:
+        while queue and len( running ) < max_jobs:
+            i, cmd = queue.pop( 0 )
+            # Log to a file rather than a pipe, so that chatty jobs don't
+            # block on a full pipe while we're waiting for another job
+            log  = tempfile.TemporaryFile()
+            proc = subprocess.Popen( cmd, stdout = log, stderr = subprocess.STDOUT )
+            running.append( ( i, proc, log ) )
+
+        # Wait for the oldest job, then refill the pool
+        i, proc, log = running.pop( 0 )
+        proc.wait()
+        log.seek( 0 )
+        results[i] = ( proc.returncode, log.read().decode( 'utf-8', 'replace' ) )
+        log.close()
+
+    return results
+
+def merge_exr_files( paths, out_path ):
+    """ Merge the channels of several multilayer EXR files into one.
+    Requires the OpenEXR python module, returns False if it's missing """
+    if not paths:
+        raise ValueError( "No EXR files to merge into " + out_path )
+
+    try:
+        import OpenEXR
+    except ImportError:
+        return False
+
+    header   = None
+    channels = {}
+    for path in paths:
+        exr = OpenEXR.InputFile( path )
+        h   = exr.header()
+        if header is None:
+            header = h
+            header['channels'] = {}
+
+        for name, channel in h['channels'].items():
+            header['channels'][ name ] = channel
+            channels[ name ] = exr.channel( name, channel.type )
+        exr.close()
+
+    out = OpenEXR.OutputFile( out_path, header )
+    out.writePixels( channels )
+    out.close()
+
+    return True
+
+def render_layers_in_parallel( scene, max_jobs, frames ):
+    """ Render each render layer of the scene in its own background blender
+    process, then merge the per-layer parts of multilayer outputs. Outputs
+    missing a layer's part (i.e. its job failed) aren't merged, so no
+    incomplete EXRs are written; the parts are kept for those, and for all
+    outputs if OpenEXR isn't available. Everything else is removed """
+    tmp_dir    = tempfile.mkdtemp( prefix = 'layer_jobs_' )
+    blend_path = os.path.join( tmp_dir, 'layer_jobs.blend' )
+    parts_dir  = os.path.join( tmp_dir, 'parts' )
+    script     = os.path.join( tmp_dir, 'layer_job.py' )
+
+    merged     = unmerged = 0
+    incomplete = []
+    failed     = []
+    try:
+        with open( script, 'w' ) as f:
+            f.write( layer_job_template )
+
+        # Jobs read the current state of the file from a copy
+        bpy.ops.wm.save_as_mainfile( filepath = blend_path, copy = True )
+
+        layers  = [ l.name for l in scene.render.layers if l.use ]
+        threads = max( 1, multiprocessing.cpu_count() // min( max_jobs, len( layers ) or 1 ) )
+
+        commands = [ [
+            bpy.app.binary_path, '-b', blend_path, '-S', scene.name,
+            '-s', str( frames[0] ), '-e', str( frames[-1] ),
+            '-P', script, '--', layer, parts_dir, str( threads ),
+            os.path.dirname( bpy.data.filepath ) or os.getcwd()
+        ] for layer in layers ]
+
+        results = run_blender_jobs( commands, max_jobs )
+        failed  = [ l for l, r in zip( layers, results ) if r[0] != 0 ]
+
+        # Merge the per-layer parts of each multilayer node, frame by frame
+        nodes = scene.node_tree.nodes
+        for node_name in os.listdir( parts_dir ) if os.path.isdir( parts_dir ) else []:
+            base_path = bpy.path.abspath( nodes[ node_name ].base_path )
+            for frame in frames:
+                out_path = base_path + '%04d.exr' % frame
+                parts    = [
+                    os.path.join( parts_dir, node_name, '%s_%04d.exr' % ( l, frame ) )
+                    for l in layers
+                ]
+                if not all( [ os.path.exists( p ) for p in parts ] ):
+                    incomplete.append( out_path )
+                elif merge_exr_files( parts, out_path ):
+                    merged += 1
+                else:
+                    unmerged += 1
+    finally:
+        keep_parts = ( unmerged or incomplete ) and os.path.isdir( parts_dir )
+        if keep_parts:
+            for path in ( blend_path, script ):
+                if os.path.exists( path ):
+                    os.remove( path )
+        else:
+            shutil.rmtree( tmp_dir, ignore_errors = True )
+
+    return {
+        'failed'     : failed,
+        'merged'     : merged,
+        'unmerged'   : unmerged,
+        'incomplete' : incomplete,
+        'parts'      : parts_dir
+    }
+
+# Prefix of the summary line each batch job prints for the batch driver
+summary_prefix = 'SAVE_PASSES_SUMMARY '
+
+def parse_batch_args( argv ):
+    parser = argparse.ArgumentParser(
+        prog        = "blender -b -P save_all_renderlayers_and_passes.py --",
+        description = "Create render layer and pass file output nodes in many .blend files"
+    )
+    parser.add_argument( 'files', nargs = '*', help = ".blend files to process" )
+    parser.add_argument( '--create-folders', action = 'store_true',
+                         help = "Create a folder for each render pass" )
+    parser.add_argument( '--per-pass', action = 'store_true',
+                         help = "Save each pass to its own file instead of multilayer EXRs" )
+    parser.add_argument( '--layout', default = 'SINGLE', choices = [ 'SINGLE', 'LAYER', 'GROUP' ],
+                         help = "How passes are split between multilayer EXR files" )
+    parser.add_argument( '--codec', choices = [ c[0] for c in exr_codecs ],
+                         help = "EXR codec of all pass groups" )
+    parser.add_argument( '--depth', choices = [ '16', '32' ],
+                         help = "EXR bit depth of all pass groups" )
+    parser.add_argument( '--base-path', help = "Render output path of the scene" )
+    parser.add_argument( '--path-template',
+                         help = "Pass file path template, i.e. {scene}/{layer}/{pass}/{layer}_{pass}" )
+    parser.add_argument( '--jobs', type = int, default = multiprocessing.cpu_count(),
+                         help = "Number of files processed at the same time" )
+    parser.add_argument( '--apply', action = 'store_true',
+                         help = "Process the currently open file (used by the batch jobs)" )
+
+    return parser.parse_args( argv )
+
+def apply_to_open_file( args ):
+    """ Create the output nodes in the open file's scene, save it and print
+    a summary for the batch driver """
+    if not hasattr( bpy.types.Scene, 'file_props' ):
+        register()
+
+    scene           = bpy.context.scene
+    scene.use_nodes = True
+
+    scene.folder_props.create_folders = args.create_folders
+    scene.file_props.single_file      = not args.per_pass
+    scene.file_props.output_layout    = args.layout
+    scene.file_props.sync_nodes       = True
+
+    for group in pass_groups:
+        settings = getattr( scene.pass_group_props, group )
+        if args.codec:
+            settings.codec = args.codec
+        if args.depth:
+            settings.depth = args.depth
+
+    if args.base_path:
+        scene.render.filepath = args.base_path
+    if args.path_template:
+        scene.file_props.path_template = args.path_template
+
+    run_with_scene( bpy.ops.render.create_file_output_nodes, scene )
+    bpy.ops.wm.save_mainfile()
+
+    file_nodes = [ n for n in scene.node_tree.nodes if n.type == 'OUTPUT_FILE' ]
+    summary    = {
+        'scene'        : scene.name,
+        'layers'       : len( scene.render.layers ),
+        'output_nodes' : len( file_nodes ),
+        'slots'        : sum( len( n.inputs ) for n in file_nodes )
+    }
+    print( summary_prefix + json.dumps( summary ) )
+
+def run_batch( args ):
+    """ Process each .blend file in its own background blender process and
+    print a summary line per file """
+    options = sys.argv[ sys.argv.index( '--' ) + 1: ]
+    options = [ o for o in options if o not in args.files ]
+
+    commands = [ [
+        bpy.app.binary_path, '-b', path, '-P', os.path.abspath( __file__ ),
+        '--', '--apply'
+    ] + options for path in args.files ]
+
+    results = run_blender_jobs( commands, max( 1, args.jobs ) )
+
+    failures = 0
+    for path, ( code, output ) in zip( args.files, results ):
+        summary = [
+            l[ len( summary_prefix ): ] for l in output.splitlines()
+            if l.startswith( summary_prefix )
+        ]
+        if code == 0 and summary:
+            info = json.loads( summary[-1] )
+            print( "OK     %s: %d layers, %d output nodes, %d slots" % (
+                path, info['layers'], info['output_nodes'], info['slots']
+            ) )
+        else:
+            failures += 1
+            last_lines = output.strip().splitlines()[-5:]
+            print( "FAILED %s:\n    %s" % ( path, "\n    ".join( last_lines ) ) )
+
+    print( "%d files processed, %d failed" % ( len( args.files ), failures ) )
+    return failures
+
+def main( argv ):
+    args = parse_batch_args( argv )
+    if args.apply:
+        apply_to_open_file( args )
+    else:
+        sys.exit( 1 if run_batch( args ) else 0 )
+
+# Render timing of the frame being rendered, filled by the render handlers
+render_timing = {}
+
+# File extensions written by file output nodes, by file format
+format_extensions = {
+    'BMP'                 : '.bmp',
+    'PNG'                 : '.png',
+    'JPEG'                : '.jpg',
+    'JPEG2000'            : '.jp2',
+    'TARGA'               : '.tga',
+    'TARGA_RAW'           : '.tga',
+    'TIFF'                : '.tif',
+    'OPEN_EXR'            : '.exr',
+    'OPEN_EXR_MULTILAYER' : '.exr',
+    'HDR'                 : '.hdr',
+    'DPX'                 : '.dpx',
+    'CINEON'              : '.cin'
+}
+
+def frame_path( path, frame, extension ):
+    """ Resolve a file output path for a frame, as blender does: the last
+    run of '#' is replaced by the padded frame number, or the number is
+    appended to the path """
+    hashes = re.findall( '#+', path )
+    if hashes:
+        digits = hashes[-1]
+        i      = path.rfind( digits )
+        path   = path[:i] + str( frame ).zfill( len( digits ) ) + path[ i + len( digits ): ]
+    else:
+        path = path + "%04d" % frame
+
+    return bpy.path.abspath( path ) + extension
+
+def get_output_files( scene, frame ):
+    """ List the files written by the compositor's file output nodes for a
+    frame, with the render layer that feeds each file, its size and when it
+    was last written """
+    files = []
+    for node in scene.node_tree.nodes:
+        if node.type != 'OUTPUT_FILE':
+            continue
+
+        ext = format_extensions.get( node.format.file_format, '' )
+        if node.format.file_format == 'OPEN_EXR_MULTILAYER':
+            layers = set( [
+                getattr( s.links[0].from_node, 'layer', '' ) for s in node.inputs if s.links
+            ] )
+            layers.discard( '' )
+            paths = [ ( frame_path( node.base_path, frame, ext ), ", ".join( sorted( layers ) ) ) ]
+        else:
+            paths = [
+                (
+                    frame_path( os.path.join( node.base_path, slot.path ), frame, ext ),
+                    getattr( socket.links[0].from_node, 'layer', '' ) if socket.links else ''
+                ) for slot, socket in zip( node.file_slots, node.inputs )
+            ]
+
+        for path, layer in paths:
+            if os.path.exists( path ):
+                files.append( {
+                    'path'  : path,
+                    'layer' : layer,
+                    'bytes' : os.path.getsize( path ),
+                    'mtime' : os.path.getmtime( path )
+                } )
+
+    return files
+
+def write_span( files ):
+    """ Time between the first and the last of these files being written,
+    from their modification times. The first file's own write isn't
+    included, so this is the write time of all the other files """
+    mtimes = [ f['mtime'] for f in files ]
+    return round( max( mtimes ) - min( mtimes ), 3 ) if mtimes else 0.0
+
+@persistent
+def log_render_pre( scene, *args ):
+    render_timing.clear()
+    if scene.file_props.use_render_log:
+        render_timing['start'] = time.time()
+
+@persistent
+def log_render_cancel( scene, *args ):
+    render_timing.clear()
+
+@persistent
+def log_render_post( scene, *args ):
+    """ Append the frame's timing and output file sizes to the render log.
+    Blender doesn't report when each render layer starts and ends, so the
+    per layer figures are the bytes written from each layer and the write
+    span of its files (see write_span) """
+    if not scene.file_props.use_render_log or 'start' not in render_timing:
+        return
+
+    now   = time.time()
+    frame = scene.frame_current
+    files = [
+        f for f in ( get_output_files( scene, frame ) if scene.use_nodes else [] )
+        if f['mtime'] >= render_timing['start']
+    ]
+
+    layers = OrderedDict()
+    for l in scene.render.layers:
+        layer_files = [ f for f in files if f['layer'] == l.name ]
+        if layer_files:
+            layers[ l.name ] = {
+                'bytes'      : sum( f['bytes'] for f in layer_files ),
+                'write_span' : write_span( layer_files )
+            }
+
+    entry = {
+        'scene'      : scene.name,
+        'frame'      : frame,
+        'frame_time' : round( now - render_timing['start'], 3 ),
+        'write_span' : write_span( files ),
+        'layers'     : layers,
+        'files'      : files
+    }
+
+    folder = os.path.dirname( bpy.path.abspath( scene.render.filepath ) )
+    if not os.path.isdir( folder ):
+        os.makedirs( folder )
+
+    with open( os.path.join( folder, 'render_log.jsonl' ), 'a' ) as log:
+        log.write( json.dumps( entry ) + "\n" )
+
+    render_timing.clear()
+
+render_log_handlers = [
+    ( 'render_pre',    log_render_pre    ),
+    ( 'render_cancel', log_render_cancel ),
+    ( 'render_post',   log_render_post   )
+]
 
 class save_images(bpy.types.Panel):
     bl_idname      = "SaveImages"
@@ -58,7 +1135,49 @@ class save_images(bpy.types.Panel):
         layout = self.layout
         layout.operator( 'render.create_file_output_nodes' )
         layout.prop( folder_props, 'create_folders' )
+        layout.prop( file_props, 'path_template' )
         layout.prop( file_props, 'single_file' )
+        if file_props.single_file:
+            layout.prop( file_props, 'output_layout' )
+
+            box = layout.box()
+            for group in pass_groups:
+                settings = getattr( context.scene.pass_group_props, group )
+                row = box.row()
+                row.label( group.capitalize() )
+                row.prop( settings, 'codec', text = '' )
+                row.prop( settings, 'depth', text = '' )
+
+        layout.prop( file_props, 'sync_nodes' )
+        layout.prop( file_props, 'use_render_log' )
+
+        layout.separator()
+        box = layout.box()
+        box.label( "Unused pass pruning" )
+        box.prop( file_props, 'pass_manifest' )
+        box.prop( file_props, 'prune_passes', expand = True )
+        box.operator( 'render.analyse_pass_usage', icon = 'VIEWZOOM' )
+
+        bench_props = context.scene.pass_benchmark_props
+        layout.separator()
+        box = layout.box()
+        box.label( "Output benchmark" )
+        col = box.column( align = True )
+        col.prop( bench_props, 'num_layers' )
+        col.prop( bench_props, 'num_passes' )
+        col.prop( bench_props, 'resolution' )
+        box.prop( bench_props, 'codecs' )
+        box.prop( bench_props, 'folder' )
+        box.operator( 'render.benchmark_pass_outputs', icon = 'TIME' )
+
+        parallel_props = context.scene.parallel_render_props
+        layout.separator()
+        box = layout.box()
+        box.label( "Parallel layer rendering" )
+        row = box.row()
+        row.prop( parallel_props, 'max_jobs' )
+        row.prop( parallel_props, 'use_animation' )
+        box.operator( 'render.render_layers_parallel', icon = 'RENDER_STILL' )
 
 
 class create_nodes( bpy.types.Operator ):
@@ -72,7 +1191,8 @@ class create_nodes( bpy.types.Operator ):
         'new' : {
             'RL' : 'CompositorNodeRLayers',
             'OF' : 'CompositorNodeOutputFile',
-            'OC' : 'CompositorNodeComposite'
+            'OC' : 'CompositorNodeComposite',
+            'FR' : 'NodeFrame'
         },
         'old' : {
             'RL' : 'R_LAYERS',
@@ -86,46 +1206,62 @@ class create_nodes( bpy.types.Operator ):
         return context.scene.use_nodes
 
     def find_base_name( self ):
-        blendfile = bpy.path.basename(bpy.data.filepath)
+        filepath = bpy.data.filepath
+        if filepath in base_names:
+            return base_names[ filepath ]
 
-        pattern   = '^([\d\w_-]+)(\.blend)$'
-        re_match  = re.match(pattern, blendfile)
+        blendfile = bpy.path.basename( filepath )
+        re_match  = blendfile_pattern.match( blendfile )
         basename  = 'scene'  # Default to avoid empty strings
 
         if re_match:
-            if len( re_match.groups() ) > 0:
-                basename  = re_match.groups()[0]
+            basename = re_match.group( 1 )
 
+        base_names[ filepath ] = basename
         return( basename )
 
+    def get_template( self, context ):
+        """ The user's path template, or the default one """
+        template = context.scene.file_props.path_template
+        if not template:
+            if context.scene.folder_props.create_folders:
+                template = folder_template
+            else:
+                template = file_template
+
+        return get_path_template( template )
+
     def get_layers_and_passes( self, context, basename ):
-        rl = context.scene.render.layers
-        use_folders = context.scene.folder_props.create_folders
+        rl       = context.scene.render.layers
+        schema   = get_pass_schema()
+        template = self.get_template( context )
+        props    = context.scene.file_props
 
-        layers = {}
+        manifest = None
+        if props.prune_passes != 'OFF' and props.pass_manifest:
+            manifest = load_pass_manifest( props.pass_manifest )
 
-        pass_attr_str = 'use_pass_'
+        layers = OrderedDict()
 
         for l in rl:
-            imagebase = basename + "_" + l.name
             layers[l.name] = []
-
-            # List all the attributes of the render layer pass with dir
-            # then isolate all the render pass attributes
-            passes = [ p for p in dir(l) if pass_attr_str in p ]
-
-            for p in passes:
-                # If render pass is active (True) - create output
-                if getattr( l, p ):
-                    pass_name = p[len(pass_attr_str):]
-
-                    if use_folders:
-                        # Distribute into subfolders for each layer and pass
-                        # Example: Scene/RenderLayer/ambient_occlusion/...
-                        file_path = context.scene.name + "/" + l.name + "/" + \
-                                    pass_name + "/" + l.name + "_" + pass_name
-                    else:
-                        file_path = imagebase + "_" + pass_name
+            path_values    = {
+                'scene' : context.scene.name,
+                'layer' : l.name,
+                'base'  : basename
+            }
+
+            for pass_name, info in schema.items():
+                # Skip the passes the comp templates don't use
+                if manifest and not is_pass_used( manifest, l.name, pass_name ):
+                    continue
+
+                # If render pass is active (True) and the renderlayer node
+                # has an output for it - create output
+                if getattr( l, info['attr'] ) and info['output']:
+                    path_values['pass']  = pass_name
+                    path_values['group'] = info['group']
+                    file_path = template.format( path_values )
 
                     pass_info = {
                         'filename' : file_path,
@@ -139,204 +1275,294 @@ class create_nodes( bpy.types.Operator ):
     def get_output( self, passout ):
         """ Find the renderlayer node's output that matches the current render
             pass """
+        schema = get_pass_schema()
+        if passout in schema:
+            return schema[ passout ]['output']
+
+        return guess_output_name( passout )
+
+    def build_output_spec( self, context, layers, version ):
+        """ Describe the file output nodes needed to save all layers and
+            passes. A single file output node for all render layers and
+            passes is much more orderly and efficient in blender versions
+            above 2.68. In 2.66 and below the API doesn't support creating
+            new file output node sockets so we'll be using a node per render
+            pass """
+        use_single_output = context.scene.file_props.single_file
+        output_layout     = context.scene.file_props.output_layout
+        base_path         = context.scene.render.filepath
+        multilayer        = use_single_output and version >= ( 2, 69 )
+        schema            = get_pass_schema()
 
-        # Renderlayer pass names and renderlayer node output names do not match
-        # which is why we're using this dictionary (and regular expressions)
-        # to match the two
-        output_dict = {
-            'ambient_occlusion' : 'AO',
-            'material_index'    : 'IndexMA',
-            'object_index'      : 'IndexOB',
-            'reflection'        : 'Reflect',
-            'refraction'        : 'Refract',
-            'combined'          : 'Image',
-            'uv'                : 'UV'
-        }
-
-        output = ''
-        if passout in output_dict.keys():
-            output = output_dict[ passout ]
-        elif "_" in passout:
-            wl = passout.split("_") # Split to list of words
-            # Capitalize first char in each word and rejoin with spaces
-            output = " ".join([ s[0].capitalize() + s[1:] for s in wl ])
-        else: # If one word, just capitlaize first letter
-            output = passout[0].capitalize() + passout[1:]
-
-        return output
-
-    def create_single_output(
-        self, context, tree, links,  node, output_node, layer, rl, use_single_output
-    ):
-        """ Create a single file output node for all render layers and
-            render passes. Much more orderly and efficient in blender versions
-            above 2.66. In 2.66 and below the API doesn't support creating
-            new file output node sockets so we'll be using another function
-            to create a node per render pass """
-
-        if use_single_output:
-            if output_node == '':
-                output_node = tree.nodes.new( type = self.node_types['new']['OF'] )
-                output_node.file_slots.clear()
-        else:
-            output_node = tree.nodes.new( type = self.node_types['new']['OF'] )
-
-        # Set base path, location, label and name
-        output_node.base_path = context.scene.render.filepath
-        output_node.location  = 500, 0
-        output_node.label     = 'file output'
-        output_node.name      = 'file output'
-
-        if use_single_output:
-            output_node.format.file_format = 'OPEN_EXR_MULTILAYER'
-
-        for rpass in layer:
-            output = self.get_output( rpass['output'] )
-
-            input_name = ''
-            if use_single_output:
-                input_name = rl + "_" + output
-            else:
-                input_name = output
-
-            if not use_single_output and output == 'Image' and not output_node.inputs[ output ].links:
-                links.new( node.outputs[ output ], output_node.inputs[ output ])
-            elif output:
-                # Add file output socket
-                output_node.file_slots.new( name = input_name )
-
-                file_path = rpass['filename']
-                output_node.file_slots[-1].path = rpass['filename']
-
-                # Set up links
-                links.new( node.outputs[ output ], output_node.inputs[-1] )
-
-        return output_node
-
-    def create_output_per_pass(
-        self, context, tree, links, node, blver, layers, rl, output_number
-    ):
-        for rpass in layers[rl]:
-            ## Create a new file output node
+        outputs = OrderedDict()
+        for rl in layers:
+            for rpass in layers[rl]:
+                output = self.get_output( rpass['output'] )
+                group  = schema[ rpass['output'] ]['group']
+                path   = base_path
+
+                if version < ( 2, 69 ):
+                    # Create file output node for each renderpass in each layer
+                    name = rl + "_" + rpass['output']
+                elif multilayer and output_layout == 'LAYER':
+                    name = rl + "_file output"
+                    path = base_path + rl + "_"
+                elif multilayer and output_layout == 'GROUP':
+                    name = group + "_file output"
+                    path = base_path + group + "_"
+                elif use_single_output:
+                    name = 'file output'
+                else:
+                    name = rl + "_file output"
+
+                if name not in outputs:
+                    outputs[ name ] = {
+                        'multilayer' : multilayer,
+                        'base_path'  : path,
+                        'groups'     : set(),
+                        'slots'      : []
+                    }
 
-            output_node = ''
-            # Create file output node for each renderpass in each layer
-            output_node = tree.nodes.new( type = self.node_types[blver]['OF'] )
+                outputs[ name ]['groups'].add( group )
+
+                outputs[ name ]['slots'].append( {
+                    'name'   : rl + "_" + output,
+                    'path'   : rpass['filename'],
+                    'layer'  : rl,
+                    'output' : output
+                } )
+
+        # Set each multilayer file's compression from its pass groups: the
+        # strictest group's codec, and float depth if any group needs it
+        group_props = context.scene.pass_group_props
+        for out in outputs.values():
+            settings = [
+                getattr( group_props, g ) for g in pass_groups if g in out['groups']
+            ]
+            out['codec'] = settings[0].codec
+            out['depth'] = max( s.depth for s in settings )
+
+        return {
+            'types'   : self.node_types[ 'new' if version > ( 2, 66 ) else 'old' ],
+            'layers'  : list( layers ),
+            'outputs' : outputs
+        }
 
-            # Select and activate file output node
-            output_node.select = True
-            tree.nodes.active  = output_node
+    def execute( self, context ):
+        # Make sure pass names map to this version's node outputs
+        blver = 'new' if bpy.app.version[:2] > ( 2, 66 ) else 'old'
+        validate_pass_schema( context.scene.node_tree, self.node_types[blver]['RL'] )
+
+        basename = self.find_base_name()
+        try:
+            layers = self.get_layers_and_passes( context, basename )
+        except ( IOError, OSError, ValueError ) as e:
+            # Bad path template or unreadable pass manifest
+            self.report( {'ERROR'}, str( e ) )
+            return {'CANCELLED'}
+
+        spec = self.build_output_spec( context, layers, bpy.app.version[:2] )
+        sync = context.scene.file_props.sync_nodes
+
+        # Multilayer files name their slots by layer and pass, but each
+        # separate file needs a path of its own
+        paths = [
+            slot['path'] for out in spec['outputs'].values()
+            if not out['multilayer'] for slot in out['slots']
+        ]
+        collisions = find_path_collisions( paths )
+        if collisions:
+            self.report( {'ERROR'}, "Path template gives the same path to several passes: " + ", ".join( collisions ) )
+            return {'CANCELLED'}
+
+        stats = sync_output_nodes( context.scene, spec, sync )
+
+        self.report( {'INFO'}, "Nodes added: %d, removed: %d, relinked: %d" % (
+            stats['added'], stats['removed'], stats['relinked']
+        ) )
 
-            # Set node position x,y values
-            file_node_x = 500
-            file_node_y = 200 * output_number
+        return {'FINISHED'}
 
-            name = rl + "_" + rpass['output']
+class benchmark_outputs( bpy.types.Operator ):
+    """ Measure the disk throughput of each output layout and codec """
+    bl_idname      = "render.benchmark_pass_outputs"
+    bl_label       = "Benchmark Outputs"
+    bl_description = "Render a synthetic scene through each output layout and codec and report bytes written and write and read times"
 
-            # Set node location, label and name
-            output_node.location = file_node_x, file_node_y
-            output_node.label    = name
-            output_node.name     = name
+    def execute( self, context ):
+        props  = context.scene.pass_benchmark_props
+        codecs = [ c.strip().upper() for c in props.codecs.split(',') if c.strip() ]
+        folder = bpy.path.abspath( props.folder )
+
+        known = [ c[0] for c in exr_codecs ]
+        if not all( [ c in known for c in codecs ] ):
+            self.report( {'ERROR'}, "Codecs must be among: " + ", ".join( known ) )
+            return {'CANCELLED'}
+
+        scene = create_benchmark_scene(
+            props.num_layers, props.num_passes, props.resolution
+        )
+
+        try:
+            results = benchmark_output_configs( scene, folder, codecs )
+        finally:
+            remove_benchmark_scene( scene )
+
+        report = format_benchmark_report( results )
+        print( report )
+
+        if 'pass_benchmark_report' not in bpy.data.texts:
+            bpy.data.texts.new( 'pass_benchmark_report' )
+        text = bpy.data.texts['pass_benchmark_report']
+        text.clear()
+        text.write( report )
+
+        self.report( {'INFO'}, "Benchmark done, see the pass_benchmark_report text" )
+        return {'FINISHED'}
 
-            # Set up file output path
-            output_node.file_slots[0].path = rpass['filename']
-            output_node.base_path          = context.scene.render.filepath
+class analyse_pass_usage( bpy.types.Operator ):
+    """ Find the enabled passes the comp templates don't use """
+    bl_idname      = "render.analyse_pass_usage"
+    bl_label       = "Analyse Pass Usage"
+    bl_description = "Report enabled passes missing from the pass manifest and the estimated savings of dropping them, and disable them if pruning is set to Disable"
+    bl_options     = {'REGISTER', 'UNDO' }
 
-            output = self.get_output( rpass['output'] )
+    @classmethod
+    def poll( self, context ):
+        return context.scene.file_props.pass_manifest != ''
 
-            # Set up links
-            if output:
-                links.new( node.outputs[ output ], output_node.inputs[0] )
+    def execute( self, context ):
+        scene = context.scene
+        props = scene.file_props
+
+        try:
+            manifest = load_pass_manifest( props.pass_manifest )
+        except ( IOError, OSError, ValueError ) as e:
+            self.report( {'ERROR'}, "Can't read pass manifest: " + str( e ) )
+            return {'CANCELLED'}
+
+        unused      = find_unused_passes( scene, manifest )
+        saved_bytes = sum( estimate_pass_bytes( scene, p ) for l, p in unused )
+        throughput  = get_write_throughput( scene )
+
+        lines = [ "%-24s %-28s %10s" % ( 'layer', 'pass', 'MB/frame' ) ]
+        for layer, pass_name in unused:
+            lines.append( "%-24s %-28s %10.2f" % (
+                layer, pass_name, estimate_pass_bytes( scene, pass_name ) / 1048576.0
+            ) )
+
+        summary = "%d unused passes, ~%.1f MB per frame" % (
+            len( unused ), saved_bytes / 1048576.0
+        )
+        if throughput:
+            summary += ", ~%.2f s write time per frame" % ( saved_bytes / throughput )
+        lines.append( summary )
+
+        if props.prune_passes == 'DISABLE':
+            schema = get_pass_schema()
+            layers = scene.render.layers
+            for layer, pass_name in unused:
+                setattr( layers[ layer ], schema[ pass_name ]['attr'], False )
+            lines.append( "Unused passes disabled" )
+
+        report = "\n".join( lines )
+        print( report )
+
+        if 'pass_usage_report' not in bpy.data.texts:
+            bpy.data.texts.new( 'pass_usage_report' )
+        text = bpy.data.texts['pass_usage_report']
+        text.clear()
+        text.write( report )
+
+        self.report( {'INFO'}, summary )
+        return {'FINISHED'}
 
-            output_number += 1
+class render_layers_parallel( bpy.types.Operator ):
+    """ Render each render layer in its own background blender process """
+    bl_idname      = "render.render_layers_parallel"
+    bl_label       = "Render Layers in Parallel"
+    bl_description = "Render each render layer in a separate background process and merge the multilayer outputs"
 
-        return output_number
+    @classmethod
+    def poll( self, context ):
+        return context.scene.use_nodes
 
     def execute( self, context ):
-        basename    = self.find_base_name()
-        layers      = self.get_layers_and_passes( context, basename )
+        scene = context.scene
+        props = scene.parallel_render_props
 
-        # create references to node tree and node links
-        tree  = bpy.context.scene.node_tree
-        links = tree.links
+        if props.use_animation:
+            frames = list( range( scene.frame_start, scene.frame_end + 1 ) )
+        else:
+            frames = [ scene.frame_current ]
 
-        use_single_output = context.scene.file_props.single_file
+        result = render_layers_in_parallel( scene, props.max_jobs, frames )
 
-        rl_nodes_y   = 0
-        file_nodes_x = 0
+        if result['failed'] or result['incomplete']:
+            self.report(
+                {'ERROR'},
+                "Layers failed to render: %s. %d outputs not merged, per-layer files left in %s" % (
+                    ", ".join( result['failed'] ) or "none", len( result['incomplete'] ), result['parts']
+                )
+            )
+        elif result['unmerged']:
+            self.report(
+                {'WARNING'},
+                "OpenEXR python module not found, per-layer files left in " + result['parts']
+            )
+        else:
+            self.report( {'INFO'}, "Rendered, %d multilayer files merged" % result['merged'] )
 
-        output_number = 0
-        node = ''  # Initialize node so that it would exist outside the loop
+        return {'FINISHED'}
 
-        # Get blender version
-        version = bpy.app.version[1]
+class parallel_options( bpy.types.PropertyGroup ):
+    max_jobs = bpy.props.IntProperty(
+        description = "Maximum number of render layers rendered at the same time",
+        name        = "Jobs",
+        default     = 2,
+        min         = 1
+    )
 
-        output_node = ''
+    use_animation = bpy.props.BoolProperty(
+        description = "Render the whole frame range instead of the current frame",
+        name        = "Animation",
+        default     = False
+    )
 
-        for rl in layers:
-            # Create a new render layer node
-            node = ''
-            if version > 66:
-                node = tree.nodes.new( type = self.node_types['new']['RL'] )
-            else:
-                node = tree.nodes.new( type = self.node_types['old']['RL'] )
-
-            # Set node location, label and name
-            node.location = 0, rl_nodes_y
-            node.label    = rl
-            node.name     = rl
-
-            # Select the relevant render layer
-            node.layer = rl
-
-            if version > 66:
-                if version < 69:
-                    output_number = self.create_output_per_pass(
-                        context,
-                        tree,
-                        links,
-                        node,
-                        'new',
-                        layers,
-                        rl,
-                        output_number
-                    )
-                else:
-                    output_node = self.create_single_output(
-                        context,
-                        tree,
-                        links,
-                        node,
-                        output_node,
-                        layers[rl],
-                        rl,
-                        use_single_output
-                    )
-            else:
-                output_number = self.create_output_per_pass(
-                    context,
-                    tree,
-                    links,
-                    node,
-                    'old',
-                    layers,
-                    rl,
-                    output_number
-                )
+class benchmark_options( bpy.types.PropertyGroup ):
+    num_layers = bpy.props.IntProperty(
+        description = "Number of render layers in the benchmark scene",
+        name        = "Layers",
+        default     = 3,
+        min         = 1
+    )
 
-            rl_nodes_y -= 300
+    num_passes = bpy.props.IntProperty(
+        description = "Number of passes enabled on each render layer",
+        name        = "Passes",
+        default     = 10,
+        min         = 1
+    )
 
-        # Create composite node, just to enable rendering
-        cnode = ''
-        if version > 66:
-            cnode = tree.nodes.new( type = self.node_types['new']['OC'] )
-        else:
-            cnode = tree.nodes.new( type = self.node_types['old']['OC'] )
+    resolution = bpy.props.IntProperty(
+        description = "Width and height of the benchmark renders",
+        name        = "Resolution",
+        default     = 1024,
+        min         = 16
+    )
 
-        # Link composite node with the last render layer created
-        links.new( node.outputs[ 'Image' ], cnode.inputs[0] )
+    codecs = bpy.props.StringProperty(
+        description = "Comma separated list of EXR codecs to test",
+        name        = "Codecs",
+        default     = "NONE, ZIP, PIZ, DWAA"
+    )
 
-        return {'FINISHED'}
+    folder = bpy.props.StringProperty(
+        description = "Folder the benchmark files are written to",
+        name        = "Folder",
+        default     = "//pass_benchmark/",
+        subtype     = 'DIR_PATH'
+    )
 
 class folder_options( bpy.types.PropertyGroup ):
     create_folders = bpy.props.BoolProperty(
@@ -352,14 +1578,116 @@ class file_options( bpy.types.PropertyGroup ):
         default     = True
     )
 
+    layouts = [
+        ( 'SINGLE', 'Single File',    'One multilayer file for all layers and passes' ),
+        ( 'LAYER',  'Per Layer',      'One multilayer file per render layer' ),
+        ( 'GROUP',  'Per Pass Group', 'One multilayer file per pass group (beauty, data, crypto)' )
+    ]
+
+    output_layout = bpy.props.EnumProperty(
+        description = "How passes are split between multilayer EXR files",
+        name        = "Layout",
+        items       = layouts,
+        default     = 'SINGLE'
+    )
+
+    path_template = bpy.props.StringProperty(
+        description = "File path of each pass, using {scene}, {layer}, {pass}, {group}, {base} (blend file name) and {frame:04d}. Leave empty for the default naming",
+        name        = "Path Template",
+        default     = ""
+    )
+
+    use_render_log = bpy.props.BoolProperty(
+        description = "Log frame times and the sizes and write times (from file modification times) of the file output nodes' files of each frame to render_log.jsonl in the render output folder",
+        name        = "Log Render Stats",
+        default     = False
+    )
+
+    pass_manifest = bpy.props.StringProperty(
+        description = "JSON manifest of the passes the comp templates use",
+        name        = "Pass Manifest",
+        default     = "",
+        subtype     = 'FILE_PATH'
+    )
+
+    prune_modes = [
+        ( 'OFF',     'Off',     'Save all enabled passes' ),
+        ( 'SKIP',    'Skip',    "Don't create outputs for passes missing from the manifest" ),
+        ( 'DISABLE', 'Disable', 'Disable passes missing from the manifest when analysing' )
+    ]
+
+    prune_passes = bpy.props.EnumProperty(
+        description = "What to do with enabled passes the pass manifest doesn't use",
+        name        = "Prune Passes",
+        items       = prune_modes,
+        default     = 'OFF'
+    )
+
+    sync_nodes = bpy.props.BoolProperty(
+        description = "Update the nodes created on previous runs instead of adding new ones",
+        name        = "Update Existing Nodes",
+        default     = True
+    )
+
+class pass_group_options( bpy.types.PropertyGroup ):
+    depths = [ ( '16', 'Half', '' ), ( '32', 'Float', '' ) ]
+
+    codec = bpy.props.EnumProperty(
+        description = "Compression codec of this group's multilayer EXR",
+        name        = "Codec",
+        items       = exr_codecs,
+        default     = 'ZIP'
+    )
+
+    depth = bpy.props.EnumProperty(
+        description = "Bit depth of this group's multilayer EXR",
+        name        = "Depth",
+        items       = depths,
+        default     = '32'
+    )
+
+class pass_groups_options( bpy.types.PropertyGroup ):
+    beauty = bpy.props.PointerProperty( type = pass_group_options )
+    data   = bpy.props.PointerProperty( type = pass_group_options )
+    crypto = bpy.props.PointerProperty( type = pass_group_options )
+
 def register():
     bpy.utils.register_module(__name__)
+    get_pass_schema()
     bpy.types.Scene.folder_props = bpy.props.PointerProperty(
         type = folder_options
     )
     bpy.types.Scene.file_props = bpy.props.PointerProperty(
         type = file_options
     )
+    bpy.types.Scene.pass_group_props = bpy.props.PointerProperty(
+        type = pass_groups_options
+    )
+    bpy.types.Scene.pass_benchmark_props = bpy.props.PointerProperty(
+        type = benchmark_options
+    )
+    bpy.types.Scene.parallel_render_props = bpy.props.PointerProperty(
+        type = parallel_options
+    )
+
+    # Not every handler exists in every blender version
+    for name, handler in render_log_handlers:
+        handlers = getattr( bpy.app.handlers, name, None )
+        if handlers is not None and handler not in handlers:
+            handlers.append( handler )
 
 def unregister():
     bpy.utils.unregister_module(__name__)
+
+    for name, handler in render_log_handlers:
+        handlers = getattr( bpy.app.handlers, name, None )
+        if handlers is not None and handler in handlers:
+            handlers.remove( handler )
+
+if __name__ == "__main__":
+    # Run as a batch tool when given arguments from the command line:
+    # blender -b -P save_all_renderlayers_and_passes.py -- shot1.blend shot2.blend
+    if '--' in sys.argv:
+        main( sys.argv[ sys.argv.index( '--' ) + 1: ] )
+    else:
+        register()
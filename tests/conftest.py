@@ -0,0 +1,48 @@
+import os, sys, types
+
+# The add-ons are single files at the repository root
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+class stub_module( types.ModuleType ):
+    """ Module whose missing attributes are made by a factory, so that the
+    add-ons' class definitions (bpy.types bases, bpy.props calls) import """
+    def __init__( self, name, factory, **attrs ):
+        types.ModuleType.__init__( self, name )
+        self._factory = factory
+        self.__dict__.update( attrs )
+
+    def __getattr__( self, name ):
+        if name.startswith( '__' ):
+            raise AttributeError( name )
+        value = self._factory( name )
+        setattr( self, name, value )
+        return value
+
+def install_blender_stubs():
+    """ Stand-ins for blender's modules outside of blender, enough to import
+    the add-ons and test their pure python parts. Anything that needs blender
+    itself still fails """
+    bpy = stub_module( 'bpy', lambda name: stub_module( 'bpy.' + name, lambda n: None ) )
+    bpy.types = stub_module( 'bpy.types', lambda name: type( name, (), {} ) )
+    bpy.props = stub_module( 'bpy.props', lambda name: lambda *args, **kwargs: None )
+    bpy.app   = stub_module(
+        'bpy.app', lambda name: None, version = ( 2, 79, 0 ),
+        handlers = stub_module( 'bpy.app.handlers', lambda name: [], persistent = lambda f: f )
+    )
+
+    mathutils = stub_module( 'mathutils', lambda name: type( name, (), {} ) )
+
+    sys.modules.update( {
+        'bpy'              : bpy,
+        'bpy.types'        : bpy.types,
+        'bpy.props'        : bpy.props,
+        'bpy.app'          : bpy.app,
+        'bpy.app.handlers' : bpy.app.handlers,
+        'bmesh'            : stub_module( 'bmesh', lambda name: None ),
+        'mathutils'        : mathutils
+    } )
+
+try:
+    import bpy
+except ImportError:
+    install_blender_stubs()
@@ -0,0 +1,44 @@
+import array
+
+import pytest
+
+bpy      = pytest.importorskip( "bpy" )
+fake_hdr = pytest.importorskip( "fake_hdr" )
+
+def test_downsample_averages_2x2_blocks():
+    # 4x2 RGBA image, each 2x2 block a single value per channel
+    values = [ 1, 1, 3, 3,
+               1, 1, 3, 3 ]
+    pixels = array.array( 'f', [ v for v in values for c in range( 4 ) ] )
+
+    w, h, out = fake_hdr.downsample( ( 4, 2, pixels ) )
+
+    assert ( w, h ) == ( 2, 1 )
+    assert list( out ) == [ 1.0 ] * 4 + [ 3.0 ] * 4
+
+def test_downsample_odd_sizes_clamp_to_the_edge():
+    pixels = array.array( 'f', [ 2.0 ] * 3 * 3 * 4 )
+    w, h, out = fake_hdr.downsample( ( 3, 3, pixels ) )
+
+    assert ( w, h ) == ( 1, 1 )
+    assert list( out ) == [ 2.0 ] * 4
+
+def test_lamp_cache_round_trip( tmp_path ):
+    path    = str( tmp_path / "image.hdr.fakehdr" )
+    digest  = b'\x01' * 20
+    lamps   = [ ( ( 1.0, 0.0, 0.0 ), ( 1.0, 0.5, 0.25 ), 4.0 ) ]
+    entries = { fake_hdr.get_cache_key( 10, 'MIP_SAMPLE' ) : lamps }
+
+    fake_hdr.write_lamp_cache( path, digest, entries )
+
+    assert fake_hdr.read_lamp_cache( path ) == ( digest, entries )
+
+def test_lamp_cache_ignores_other_versions( tmp_path ):
+    path = str( tmp_path / "image.hdr.fakehdr" )
+    fake_hdr.write_lamp_cache( path, b'\x01' * 20, {} )
+
+    with open( path, 'r+b' ) as f:
+        f.seek( 4 )
+        f.write( b'\xff\xff' )
+
+    assert fake_hdr.read_lamp_cache( path ) == ( None, {} )
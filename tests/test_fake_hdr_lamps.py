@@ -0,0 +1,24 @@
+import pytest
+
+bpy      = pytest.importorskip( "bpy" )
+fake_hdr = pytest.importorskip( "fake_hdr" )
+
+def assert_close( a, b ):
+    assert max( [ abs( x - y ) for x, y in zip( a, b ) ] ) < 1e-6
+
+def test_lamp_color_times_intensity_is_sampled_color():
+    samples = [
+        ( ( 1, 0, 0 ), ( 0.5, 0.5, 0.5 ) ),  # LDR gray
+        ( ( 0, 1, 0 ), ( 4.0, 0.0, 0.0 ) ),  # HDR red
+        ( ( 0, 0, 1 ), ( 2.0, 1.0, 0.5 ) )
+    ]
+    lamp_data = fake_hdr.make_lamp_data( samples, len( samples ) )
+    sampled   = dict( samples )
+
+    assert len( lamp_data ) == len( samples )
+    for direction, color, intensity in lamp_data:
+        assert abs( max( color ) - 1 ) < 1e-6
+        assert_close( [ c * intensity for c in color ], sampled[ direction ] )
+
+def test_black_samples_have_no_intensity():
+    assert fake_hdr.normalize_color( ( 0.0, 0.0, 0.0 ) ) == ( ( 0.0, 0.0, 0.0 ), 0.0 )
@@ -0,0 +1,29 @@
+import math
+
+import pytest
+
+bpy      = pytest.importorskip( "bpy" )
+fake_hdr = pytest.importorskip( "fake_hdr" )
+
+def pixel_lon_lat( col, row, width, height ):
+    """ Longitude and latitude of a pixel's center """
+    return ( ( col + 0.5 ) / width - 0.5 ) * 2 * math.pi, ( ( row + 0.5 ) / height - 0.5 ) * math.pi
+
+def assert_close( a, b ):
+    assert max( [ abs( x - y ) for x, y in zip( a, b ) ] ) < 1e-3
+
+def test_image_center_looks_down_x():
+    # Blender's environment texture maps u = 0.5, v = 0.5 to +X
+    assert_close( fake_hdr.lon_lat_to_direction( *pixel_lon_lat( 512, 256, 1025, 513 ) ), ( 1, 0, 0 ) )
+
+def test_known_pixels():
+    # u = 0.75 is -Y, u = 0.25 is +Y, the top row is +Z
+    assert_close( fake_hdr.lon_lat_to_direction( 0.5 * math.pi, 0 ), ( 0, -1, 0 ) )
+    assert_close( fake_hdr.lon_lat_to_direction( -0.5 * math.pi, 0 ), ( 0, 1, 0 ) )
+    assert_close( fake_hdr.lon_lat_to_direction( *pixel_lon_lat( 0, 511, 1024, 512 ) )[2:], ( 1, ) )
+
+def test_round_trip():
+    for col, row in ( ( 10, 20 ), ( 700, 100 ), ( 1000, 400 ) ):
+        lon, lat = pixel_lon_lat( col, row, 1024, 512 )
+        d        = fake_hdr.lon_lat_to_direction( lon, lat )
+        assert_close( fake_hdr.direction_to_lon_lat( d ), ( lon, lat ) )
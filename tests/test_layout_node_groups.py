@@ -0,0 +1,38 @@
+import pytest
+
+bpy   = pytest.importorskip( "bpy" )
+saver = pytest.importorskip( "save_all_renderlayers_and_passes" )
+
+class node:
+    """ The node attributes the layout reads and writes """
+    def __init__( self, sockets = 0, width = 140, hide = False ):
+        self.inputs   = [ object() ] * sockets
+        self.outputs  = []
+        self.width    = width
+        self.hide     = hide
+        self.location = None
+        self.parent   = None
+        self.label    = ''
+
+def bottom( n ):
+    return n.location[1] - saver.estimate_node_height( n )
+
+def test_columns_and_groups_dont_overlap():
+    a, b, c = node( 3 ), node( 10, width = 300 ), node( 5 )
+    d, e    = node( 1 ), node( 2 )
+    frame   = node()
+
+    saver.layout_node_groups(
+        [ ( 'one', [ [ a ], [ b, c ] ], frame ), ( 'two', [ [ d ], [ e ] ], None ) ],
+        origin = ( 100, 50 )
+    )
+
+    assert a.location == ( 100, 50 )
+    assert frame.label == 'one' and a.parent is frame and d.parent is None
+    assert bottom( b ) > c.location[1]
+    # Columns line up across groups, the second group starts below the first
+    assert e.location[0] == b.location[0] > a.location[0] + a.width
+    assert d.location[1] < min( bottom( a ), bottom( c ) )
+
+def test_collapsed_nodes_only_take_their_header():
+    assert saver.estimate_node_height( node( 10, hide = True ) ) == saver.node_header_height